@@ -1,21 +1,25 @@
 import json
+import time
 from typing import Annotated
 
 from beanie import init_beanie
 from bson import ObjectId
-from fastapi import FastAPI, Response, Depends, Header, HTTPException
+from fastapi import FastAPI, Request, Response, Depends, Header, HTTPException
 from fastapi.middleware.httpsredirect import HTTPSRedirectMiddleware
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.routing import APIRoute
 from fastapi.staticfiles import StaticFiles
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
-from mqtt import mqtt
+from mqtt import mqtt, rpc, rpc_reply_topic
+from metrics import HTTP_REQUEST_SECONDS, MQTT_HANDLER_SECONDS, MQTT_MESSAGES, register_stats, topic_label
 from routes import base, config, calendar, knx
-from routes.knx import save_event
+from routes.knx import save_event, update_state
 
 from db import User, db
 from schemas import UserCreate, UserRead, UserUpdate
 import users
-from users import auth_backend, current_active_admin, fastapi_users, bearer_transport
+from users import auth_backend, current_active_admin, fastapi_users, bearer_transport, user_cache
 
 from misc import authenticate_token
 
@@ -29,6 +33,28 @@ app.add_middleware(
     allow_headers=['*']
 )
 
+register_stats('websocket', base.manager.stats, 'Websocket ConnectionManager statistic.')
+register_stats('websocket_fetch', lambda: base.fetch_stats, 'Websocket fetch single-flight statistic.')
+register_stats('knx_buffer', knx.event_buffer.stats, 'KNX write-behind buffer statistic.')
+register_stats('auth_cache', user_cache.stats, 'Authenticated user cache statistic.')
+register_stats('mqtt_rpc', lambda: {'pending': len(rpc.pending), 'timeouts': rpc.timeouts},
+               'MQTT request/reply statistic.')
+
+
+@app.middleware('http')
+async def measure_request(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        HTTP_REQUEST_SECONDS.labels(
+            request.method, route.path if isinstance(route, APIRoute) else 'static', status) \
+            .observe(time.perf_counter() - start)
+
 
 @app.on_event('startup')
 async def on_startup():
@@ -38,25 +64,77 @@ async def on_startup():
             User,
         ],
     )
+    await knx.ensure_indexes()
+    await calendar.ensure_indexes()
+    await knx.rollups.load()
+    await knx.load_state()
+    knx.event_buffer.start()
+    knx.retention.start()
+
+
+@app.on_event('shutdown')
+async def on_shutdown():
+    await knx.retention.close()
+    await knx.event_buffer.close()
 
 mqtt.init_app(app)
 
 
+def coalesce_key(payload: dict):
+    if not isinstance(payload, dict) or payload.get('target') is None:
+        return None
+    target = payload['target']
+    data = payload.get('data')
+    event = data.get('event') if isinstance(data, dict) else None
+    if not isinstance(event, dict):
+        return None
+    if target == 'knx':
+        return ('knx', event.get('target'))
+    if payload.get('id') is None:
+        return None
+    return (target, payload['id'], event.get('type'))
+
+
+def event_topics(payload: dict):
+    if not isinstance(payload, dict) or payload.get('target') is None:
+        return None
+    target = payload['target']
+    if target == 'knx':
+        location_id = payload['data']['event']['target']
+        return [('knx', location_id), ('location', location_id)]
+    if payload.get('id') is None:
+        return None
+    topics = [(target, payload['id'])]
+    if target == 'device':
+        topics.extend(base.data_loader.snapshot.device_topics.get(payload['id'], ()))
+    return topics
+
+
 @mqtt.on_message()
 async def on_message(client, topic, payload, qos, properties):
+    label = topic_label(topic)
+    MQTT_MESSAGES.labels(label).inc()
+    with MQTT_HANDLER_SECONDS.labels(label).time():
+        await handle_message(topic, payload)
+
+
+async def handle_message(topic, payload):
     try:
         payload = payload.decode()
         payload = json.loads(payload)
     except:
         print(f'Error: Invalid MQTT Payload. "{payload}"')
         return
+    rpc.resolve(payload)
+    if mqtt.match(topic, rpc_reply_topic):
+        return
     if mqtt.match(topic, 'manager/device_event'):
         payload['target'] = 'device'
     elif mqtt.match(topic, 'manager/tag_event'):
         payload['target'] = 'tag'
     elif mqtt.match(topic, 'manager/location_event'):
         payload['target'] = 'location'
-    elif mqtt.match(topic, 'knx/switch/#'):
+    if mqtt.match(topic, 'knx/switch/#'):
         location_id = int(topic.split('/')[2])
         object_id = str(ObjectId())
         payload = {
@@ -75,7 +153,9 @@ async def on_message(client, topic, payload, qos, properties):
             **payload,
             'target': location_id
         })
-    await base.manager.broadcast(json.dumps(payload))
+        update_state(location_id, payload['data']['event'])
+    await base.manager.publish(payload, key=coalesce_key(payload),
+                               topics=event_topics(payload))
 
 
 app.include_router(
@@ -93,6 +173,11 @@ def healthcheck():
     return 'ok'
 
 
+@app.get('/metrics')
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post('/auth/jwt/refresh', tags=['auth'])
 async def refresh_jwt(response: Response,
                       authorization: Annotated[str, Header()] = "",
@@ -0,0 +1,94 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+for key, value in {
+    'MONGO_INITDB_USERNAME': 'bench',
+    'MONGO_INITDB_PASSWORD': 'bench',
+    'MONGO_INITDB_HOSTNAME': 'localhost',
+    'MONGO_INITDB_DATABASE': 'bench',
+    'API_SECRET': 'bench',
+}.items():
+    os.environ.setdefault(key, value)
+
+from misc.data import DataLoader  # noqa: E402
+
+
+def generate(n_devices: int, interfaces_per_device: int, power_ports_per_device: int, seed: int = 0):
+    rng = random.Random(seed)
+    tags = [{'id': i, 'name': f'tag-{i}', 'slug': f'tag-{i}'} for i in range(50)]
+    devices, interfaces, ip_addresses, power_ports = [], [], [], []
+    for device_id in range(1, n_devices + 1):
+        ip_id = device_id
+        devices.append({
+            'id': device_id,
+            'name': f'device-{device_id}',
+            'status': {'value': 'active', 'label': 'Active'},
+            'location': {'id': rng.randrange(1, 500)},
+            'primary_ip': {'id': ip_id, 'address': f'10.{device_id >> 16 & 255}.{device_id >> 8 & 255}.{device_id & 255}/16'},
+        })
+        ip_addresses.append({
+            'id': ip_id,
+            'address': devices[-1]['primary_ip']['address'],
+            'tags': rng.sample(tags, 2),
+        })
+        for i in range(interfaces_per_device):
+            interfaces.append({
+                'id': len(interfaces) + 1,
+                'name': f'eth{i}',
+                'device': {'id': device_id},
+                'mac_address': None,
+            })
+        for i in range(power_ports_per_device):
+            power_ports.append({
+                'id': len(power_ports) + 1,
+                'name': f'PSU{i}',
+                'device': {'id': device_id},
+                'link_peers_type': 'dcim.poweroutlet',
+                'link_peers': [{'id': len(power_ports) + 1, 'name': f'Outlet{i}'}],
+            })
+    rng.shuffle(interfaces)
+    rng.shuffle(ip_addresses)
+    rng.shuffle(power_ports)
+    return devices, interfaces, ip_addresses, power_ports
+
+
+def run(n_devices: int, interfaces_per_device: int, power_ports_per_device: int) -> float:
+    devices, interfaces, ip_addresses, power_ports = generate(
+        n_devices, interfaces_per_device, power_ports_per_device)
+    loader = DataLoader(None)
+    loader.intermediate_data['interfaces'] = {
+        interface['id']: interface for interface in interfaces}
+    loader.intermediate_data['ip_addresses'] = {
+        ip_address['id']: ip_address for ip_address in ip_addresses}
+    loader.intermediate_data['power_ports'] = {
+        power_port['id']: power_port for power_port in power_ports}
+    start = time.perf_counter()
+    result = loader._get_devices(devices)
+    elapsed = time.perf_counter() - start
+    assert len(result) == n_devices
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the DataLoader device join on synthetic NetBox data.')
+    parser.add_argument('sizes', nargs='*', type=int,
+                        default=[1000, 10000, 50000])
+    parser.add_argument('--interfaces', type=int, default=4,
+                        help='interfaces per device')
+    parser.add_argument('--power-ports', type=int, default=2,
+                        help='power ports per device')
+    args = parser.parse_args()
+    print(f'{"devices":>10} {"seconds":>10} {"devices/s":>12}')
+    for size in args.sizes:
+        elapsed = run(size, args.interfaces, args.power_ports)
+        print(f'{size:>10} {elapsed:>10.3f} {size / elapsed:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+"""Load test of the API against local stand-ins for NetBox and MQTT.
+
+Scenarios:
+  dataloader  full and incremental DataLoader refreshes from a fake NetBox
+  snapshot    GET /api/devices through the ASGI app, plain, gzip and 304
+  fanout      MQTT device events fanned out to N websocket clients
+  knx         KNX switch events from MQTT through the write-behind buffer
+  calendar    calendar bulk upserts
+
+The knx and calendar scenarios need a MongoDB reachable with the
+MONGO_INITDB_* variables, as for the API itself. They write to bench_knx
+and bench_calendar databases, which are dropped afterwards, and are
+skipped when no server answers.
+
+    python benchmarks/load.py --devices 10000 --clients 200 --rate 1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+for key, value in {
+    'MONGO_INITDB_USERNAME': 'bench',
+    'MONGO_INITDB_PASSWORD': 'bench',
+    'MONGO_INITDB_HOSTNAME': 'localhost',
+    'MONGO_INITDB_DATABASE': 'bench',
+    'API_SECRET': 'bench',
+}.items():
+    os.environ.setdefault(key, value)
+# Every run starts from NetBox, not from a snapshot left by an earlier run.
+os.environ['SNAPSHOT_PATH'] = ''
+
+from standins import FakeNetBox, MQTTBroker, inventory  # noqa: E402
+
+scenarios = ('dataloader', 'snapshot', 'fanout', 'knx', 'calendar')
+
+
+class Result:
+    def __init__(self, scenario: str, count: int, seconds: float, latencies: list[float]):
+        self.scenario = scenario
+        self.count = count
+        self.seconds = seconds
+        self.latencies = latencies
+
+    def percentile(self, p: int) -> float:
+        if len(self.latencies) < 2:
+            return self.latencies[0] if self.latencies else float('nan')
+        return statistics.quantiles(self.latencies, n=100, method='inclusive')[p - 1]
+
+    def as_dict(self) -> dict:
+        return {
+            'scenario': self.scenario,
+            'count': self.count,
+            'seconds': self.seconds,
+            'throughput': self.count / self.seconds if self.seconds else 0,
+            **{f'p{p}_ms': self.percentile(p) * 1000 for p in (50, 95, 99)},
+        }
+
+
+def report(result: Result):
+    row = result.as_dict()
+    print(f'{row["scenario"]:<24} {row["count"]:>9} {row["seconds"]:>9.2f} {row["throughput"]:>12.0f} '
+          f'{row["p50_ms"]:>10.2f} {row["p95_ms"]:>10.2f} {row["p99_ms"]:>10.2f}', flush=True)
+
+
+def import_app():
+    """Imports the app from a scratch directory, as it mounts ./static."""
+    if 'app' not in sys.modules:
+        os.chdir(tempfile.mkdtemp(prefix='avorus-bench-'))
+        os.mkdir('static')
+    import app
+    return app
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames: list[tuple[float, str]] = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        self.frames.append((time.perf_counter(), message))
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+async def asgi_get(app, path: str, headers: dict[str, str]) -> int:
+    messages = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.Event().wait()
+        received = True
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app({
+        'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'https',
+        'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'',
+        'headers': [(b'host', b'bench')] + [
+            (key.lower().encode(), value.encode()) for key, value in headers.items()],
+        'server': ('bench', 443), 'client': ('127.0.0.1', 0),
+    }, receive, send)
+    return messages[0]['status']
+
+
+async def paced(count: int, rate: float, publish):
+    """Calls publish(i) count times at about rate calls per second."""
+    start = time.perf_counter()
+    for i in range(count):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        publish(i)
+
+
+async def bench_dataloader(args, netbox: FakeNetBox) -> list[Result]:
+    from misc import data
+
+    loop = asyncio.get_running_loop()
+    reloaded = asyncio.Queue()
+
+    async def on_reload(version, changes):
+        await reloaded.put(time.perf_counter())
+
+    loader = data.DataLoader(loop, on_reload=on_reload)
+    start = time.perf_counter()
+    loader.start()
+    results = [Result('dataloader.initial', args.devices, await reloaded.get() - start,
+                      [time.perf_counter() - start])]
+    full_sync_interval = data.netbox_full_sync_interval
+    try:
+        for mode, interval in (('full', 0), ('incremental', 60 * 60)):
+            data.netbox_full_sync_interval = interval
+            durations = []
+            for _ in range(args.reloads):
+                await asyncio.to_thread(lambda: urlopen(Request(
+                    f'{netbox.url}/bench/touch?fraction={args.touch}', method='POST')).read())
+                start = time.perf_counter()
+                loader.reload()
+                durations.append(await reloaded.get() - start)
+            results.append(Result(f'dataloader.{mode}', args.devices * args.reloads,
+                                  sum(durations), durations))
+    finally:
+        data.netbox_full_sync_interval = full_sync_interval
+    return results
+
+
+async def bench_snapshot(args) -> list[Result]:
+    app = import_app()
+    from routes import base
+    from users import current_active_user
+
+    app.app.dependency_overrides[current_active_user] = lambda: None
+    async with base.data_loader:
+        etag = base.data_loader.snapshot.payloads['devices'].etag
+    results = []
+    for variant, headers, status in (
+            ('plain', {}, 200),
+            ('gzip', {'Accept-Encoding': 'gzip'}, 200),
+            ('not_modified', {'If-None-Match': etag}, 304)):
+        latencies = []
+
+        async def client(requests: int):
+            for _ in range(requests):
+                start = time.perf_counter()
+                assert await asgi_get(app.app, '/api/devices', headers) == status
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(args.requests // args.concurrency)
+                               for _ in range(args.concurrency)))
+        results.append(Result(f'snapshot.{variant}', len(latencies),
+                              time.perf_counter() - start, latencies))
+    app.app.dependency_overrides.clear()
+    return results
+
+
+async def drain(done, timeout: float = 10):
+    deadline = time.perf_counter() + timeout
+    while not done() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def bench_fanout(args, broker: MQTTBroker) -> list[Result]:
+    import_app()
+    from routes import base
+
+    async with base.data_loader:
+        device_ids = [device['id'] for device in base.data_loader.devices]
+    sockets = [FakeWebSocket() for _ in range(args.clients)]
+    for websocket in sockets:
+        await base.manager.connect(websocket)
+    rng = random.Random(0)
+    events = int(args.rate * args.duration)
+    dropped = base.manager.stats()['dropped']
+
+    def publish(_):
+        broker.publish('manager/device_event', json.dumps({
+            'id': rng.choice(device_ids),
+            'data': {'event': {'type': 'status', 'sent': time.perf_counter()}},
+        }))
+
+    def delivered():
+        return sum(len(websocket.frames) for websocket in sockets)
+
+    start = time.perf_counter()
+    await paced(events, args.rate, publish)
+    await drain(lambda: base.manager.stats()['queued'] == 0 and delivered() > 0
+                and not base.manager.stats()['pending'])
+    await asyncio.sleep(0.1)
+    await drain(lambda: base.manager.stats()['queued'] == 0)
+    latencies = []
+    for websocket in sockets:
+        for received, frame in websocket.frames:
+            frame = json.loads(frame)
+            for message in frame if isinstance(frame, list) else [frame]:
+                if message.get('target') == 'device':
+                    latencies.append(received - message['data']['event']['sent'])
+        base.manager.disconnect(websocket)
+    end = max((received for websocket in sockets for received, _ in websocket.frames),
+              default=time.perf_counter())
+    if base.manager.stats()['dropped'] > dropped:
+        print(f'fanout: {base.manager.stats()["dropped"] - dropped} messages dropped',
+              file=sys.stderr)
+    return [Result(f'fanout.{args.clients}_clients', len(latencies), end - start, latencies)]
+
+
+async def bench_knx(args, broker: MQTTBroker, database) -> list[Result]:
+    import_app()
+    from routes import knx
+    from misc.buffer import WriteBehindBuffer
+    from misc.rollups import KNXRollups
+
+    rollups = KNXRollups(database['rollups'], database['rollup_state'], database['events'])
+    latencies = []
+    flushed = []
+
+    async def on_flush(documents: list[dict]):
+        now = time.perf_counter()
+        latencies.extend(now - document['data']['event']['sent'] for document in documents)
+        flushed.append(now)
+        await rollups.apply(documents)
+
+    buffer = WriteBehindBuffer(
+        database['events'], on_flush=on_flush, flush_size=knx.event_buffer.flush_size,
+        flush_interval=knx.event_buffer.flush_interval, max_size=knx.event_buffer.max_size)
+    event_buffer, knx.event_buffer = knx.event_buffer, buffer
+    buffer.start()
+    rng = random.Random(0)
+
+    def publish(_):
+        broker.publish(f'knx/switch/{rng.randrange(1, 500)}', json.dumps({
+            'value': rng.random() < 0.5, 'time': int(time.time()), 'sent': time.perf_counter()}))
+
+    try:
+        start = time.perf_counter()
+        await paced(args.knx_events, args.knx_rate, publish)
+        await drain(lambda: buffer.written + buffer.dropped >= args.knx_events, timeout=60)
+    finally:
+        await buffer.close()
+        knx.event_buffer = event_buffer
+    return [Result('knx.ingest', buffer.written, (flushed[-1] if flushed else time.perf_counter()) - start,
+                   latencies)]
+
+
+async def bench_calendar(args, database) -> list[Result]:
+    from bson import ObjectId
+    from models.calendar import BulkEventsModel, EventModel
+    import_app()
+    from routes import calendar
+
+    events = [EventModel(
+        _id=ObjectId(), title=f'event-{i}', start=f'2026-01-01T{i % 24:02}:00:00+00:00',
+        allDay=False, duration=3600, rrule='FREQ=DAILY' if i % 2 else None,
+        extendedProps={'id': i % 1000 + 1, 'type': 'device', 'label': f'device-{i}',
+                       'actions': {'start': 'wakeup', 'end': 'shutdown'}})
+        for i in range(args.calendar_events)]
+    calendar_db, calendar.db = calendar.db, database
+    results = []
+    try:
+        for mode in ('insert', 'update'):
+            latencies = []
+            for i in range(0, len(events), args.calendar_batch):
+                start = time.perf_counter()
+                await calendar.save_events(BulkEventsModel(upsert=events[i:i + args.calendar_batch]))
+                latencies.append(time.perf_counter() - start)
+            results.append(Result(f'calendar.bulk_{mode}', len(events), sum(latencies), latencies))
+    finally:
+        calendar.db = calendar_db
+    return results
+
+
+async def mongo_available(client) -> bool:
+    try:
+        await asyncio.wait_for(client.admin.command('ping'), 5)
+        return True
+    except Exception as e:
+        print(f'MongoDB not reachable, skipping: {e!r}', file=sys.stderr)
+        return False
+
+
+async def run(args, netbox: FakeNetBox) -> list[Result]:
+    broker = await MQTTBroker().start()
+    os.environ.update({'MQTT_HOSTNAME': '127.0.0.1', 'MQTT_PORT': str(broker.port),
+                       'MQTT_TLS': '0', 'NETBOX_API_URL': netbox.url})
+    results = []
+
+    def collect(new: list[Result]):
+        for result in new:
+            report(result)
+        results.extend(new)
+
+    print(f'{"scenario":<24} {"count":>9} {"seconds":>9} {"per second":>12} '
+          f'{"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10}', flush=True)
+    if 'dataloader' in args.scenarios:
+        collect(await bench_dataloader(args, netbox))
+    if set(args.scenarios) - {'dataloader'}:
+        from mqtt import mqtt
+        await mqtt.connection()
+        await drain(lambda: broker.subscribed('manager/device_event')
+                    and broker.subscribed('knx/switch/1'))
+    if 'snapshot' in args.scenarios:
+        collect(await bench_snapshot(args))
+    if 'fanout' in args.scenarios:
+        collect(await bench_fanout(args, broker))
+    if {'knx', 'calendar'} & set(args.scenarios):
+        from db import client
+        if await mongo_available(client):
+            for scenario in ('knx', 'calendar'):
+                if scenario not in args.scenarios:
+                    continue
+                database = client[f'bench_{scenario}']
+                await client.drop_database(database.name)
+                try:
+                    collect(await (bench_knx(args, broker, database) if scenario == 'knx'
+                                   else bench_calendar(args, database)))
+                finally:
+                    await client.drop_database(database.name)
+    if 'mqtt' in sys.modules:
+        from mqtt import mqtt
+        await mqtt.client.disconnect()
+    await broker.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the API against local NetBox, MQTT and MongoDB stand-ins.')
+    parser.add_argument('scenarios', nargs='*', default=list(scenarios),
+                        help=f'any of {", ".join(scenarios)} (default: all)')
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--interfaces', type=int, default=4, help='interfaces per device')
+    parser.add_argument('--power-ports', type=int, default=2, help='power ports per device')
+    parser.add_argument('--reloads', type=int, default=5, help='DataLoader reloads per mode')
+    parser.add_argument('--touch', type=float, default=0.01,
+                        help='share of NetBox records updated before each reload')
+    parser.add_argument('--requests', type=int, default=2000, help='snapshot GETs per variant')
+    parser.add_argument('--concurrency', type=int, default=20, help='concurrent snapshot clients')
+    parser.add_argument('--clients', type=int, default=100, help='websocket clients')
+    parser.add_argument('--rate', type=float, default=500, help='MQTT device events per second')
+    parser.add_argument('--duration', type=float, default=5, help='seconds of device events')
+    parser.add_argument('--knx-events', type=int, default=10000)
+    parser.add_argument('--knx-rate', type=float, default=2000, help='KNX events per second')
+    parser.add_argument('--calendar-events', type=int, default=5000)
+    parser.add_argument('--calendar-batch', type=int, default=500)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    for scenario in set(args.scenarios) - set(scenarios):
+        parser.error(f'unknown scenario {scenario}')
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    with FakeNetBox(inventory(args.devices, args.interfaces, args.power_ports)) as netbox:
+        results = asyncio.run(run(args, netbox))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump([result.as_dict() for result in results], file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
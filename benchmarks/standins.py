@@ -0,0 +1,287 @@
+"""Local stand-ins for the services the API talks to: a NetBox REST API
+serving a synthetic inventory and a minimal MQTT 3.1.1 broker."""
+import asyncio
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import random
+from urllib.parse import parse_qs, urlsplit
+
+netbox_max_page_size = 1000
+
+
+def inventory(n_devices: int, interfaces_per_device: int = 4, power_ports_per_device: int = 2,
+              n_tags: int = 50, n_locations: int = 500, seed: int = 0) -> dict[str, list[dict]]:
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc).isoformat()
+    tags = [{'id': i, 'name': f'tag-{i}', 'slug': f'tag-{i}', 'last_updated': now}
+            for i in range(1, n_tags + 1)]
+    locations = [{'id': i, 'name': f'location-{i}', 'slug': f'location-{i}', 'last_updated': now}
+                 for i in range(1, n_locations + 1)]
+    data = {'devices': [], 'interfaces': [], 'ip_addresses': [], 'power_ports': [],
+            'power_outlets': [], 'tags': tags, 'locations': locations, 'power_feeds': []}
+    for device_id in range(1, n_devices + 1):
+        address = f'10.{device_id >> 16 & 255}.{device_id >> 8 & 255}.{device_id & 255}/8'
+        data['devices'].append({
+            'id': device_id,
+            'name': f'device-{device_id}',
+            'status': {'value': 'active', 'label': 'Active'},
+            'location': {'id': rng.randrange(1, n_locations + 1)},
+            'primary_ip': {'id': device_id, 'address': address},
+            'last_updated': now,
+        })
+        data['ip_addresses'].append({
+            'id': device_id,
+            'address': address,
+            'tags': [{'id': tag['id'], 'name': tag['name'], 'slug': tag['slug']}
+                     for tag in rng.sample(tags, 2)],
+            'last_updated': now,
+        })
+        for i in range(interfaces_per_device):
+            data['interfaces'].append({
+                'id': len(data['interfaces']) + 1,
+                'name': f'eth{i}',
+                'device': {'id': device_id},
+                'mac_address': None,
+                'last_updated': now,
+            })
+        for i in range(power_ports_per_device):
+            outlet_id = len(data['power_outlets']) + 1
+            data['power_outlets'].append({'id': outlet_id, 'name': f'Outlet{outlet_id}',
+                                          'last_updated': now})
+            data['power_ports'].append({
+                'id': len(data['power_ports']) + 1,
+                'name': f'PSU{i}',
+                'device': {'id': device_id},
+                'link_peers_type': 'dcim.poweroutlet',
+                'link_peers': [{'id': outlet_id, 'name': f'Outlet{outlet_id}'}],
+                'last_updated': now,
+            })
+    return data
+
+
+netbox_paths = {
+    '/api/dcim/devices/': 'devices',
+    '/api/dcim/interfaces/': 'interfaces',
+    '/api/dcim/power-ports/': 'power_ports',
+    '/api/dcim/power-outlets/': 'power_outlets',
+    '/api/dcim/power-feeds/': 'power_feeds',
+    '/api/dcim/locations/': 'locations',
+    '/api/ipam/ip-addresses/': 'ip_addresses',
+    '/api/extras/tags/': 'tags',
+}
+
+
+class NetBoxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *_):
+        pass
+
+    def reply(self, body, status: int = 200):
+        encoded = json.dumps(body, separators=(',', ':')).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.send_header('API-Version', '3.7')
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/api/':
+            return self.reply({})
+        if url.path == '/api/schema/':
+            return self.reply({'openapi': '3.0.3', 'paths': {}})
+        name = netbox_paths.get(url.path)
+        if name is None:
+            return self.reply({'detail': 'Not found.'}, 404)
+        records = self.server.inventory[name]
+        if 'id' in query:
+            ids = {int(id) for id in query['id']}
+            records = [record for record in records if record['id'] in ids]
+        if 'last_updated__gte' in query:
+            since = datetime.fromisoformat(query['last_updated__gte'][0])
+            records = [record for record in records
+                       if datetime.fromisoformat(record['last_updated']) >= since]
+        if query.get('brief') == ['1']:
+            records = [{'id': record['id'], 'display': str(record['id'])} for record in records]
+        limit = int(query.get('limit', ['0'])[0]) or netbox_max_page_size
+        limit = min(limit, netbox_max_page_size)
+        offset = int(query.get('offset', ['0'])[0])
+        next_url = None
+        if offset + limit < len(records):
+            next_query = {**{key: values for key, values in query.items()},
+                          'limit': [str(limit)], 'offset': [str(offset + limit)]}
+            next_url = f'http://{self.headers["Host"]}{url.path}?' + '&'.join(
+                f'{key}={value}' for key, values in next_query.items() for value in values)
+        self.reply({'count': len(records), 'next': next_url, 'previous': None,
+                    'results': records[offset:offset + limit]})
+
+    def do_POST(self):
+        """POST /bench/touch?fraction=0.01 marks a random share of every
+        collection as updated, for incremental syncs to pick up."""
+        url = urlsplit(self.path)
+        if url.path != '/bench/touch':
+            return self.reply({'detail': 'Not found.'}, 404)
+        fraction = float(parse_qs(url.query).get('fraction', ['0.01'])[0])
+        now = datetime.now(timezone.utc).isoformat()
+        touched = 0
+        for records in self.server.inventory.values():
+            for record in random.sample(records, int(len(records) * fraction)):
+                record['last_updated'] = now
+                touched += 1
+        self.reply({'touched': touched})
+
+
+def serve_netbox(data: dict, ready: multiprocessing.Queue):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NetBoxHandler)
+    server.daemon_threads = True
+    server.inventory = data
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeNetBox:
+    """NetBox REST API stand-in, run in its own process so that serving the
+    inventory does not compete with the DataLoader for the GIL."""
+
+    def __init__(self, data: dict[str, list[dict]]):
+        self.data = data
+        self.process: multiprocessing.Process | None = None
+        self.url = ''
+
+    def __enter__(self):
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=serve_netbox, args=(self.data, ready), daemon=True)
+        self.process.start()
+        self.url = f'http://127.0.0.1:{ready.get(timeout=30)}'
+        return self
+
+    def __exit__(self, *_):
+        self.process.terminate()
+        self.process.join()
+
+
+def encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        encoded.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value: str) -> bytes:
+    encoded = value.encode()
+    return len(encoded).to_bytes(2, 'big') + encoded
+
+
+def topic_matches(subscription: str, topic: str) -> bool:
+    subscription_levels, topic_levels = subscription.split('/'), topic.split('/')
+    for i, level in enumerate(subscription_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+    return len(subscription_levels) == len(topic_levels)
+
+
+class MQTTBroker:
+    """Minimal in-process MQTT 3.1.1 broker over plain TCP. Deliveries are
+    QoS 0; QoS 1 publishes are acknowledged. No retained messages, sessions
+    or wills."""
+
+    def __init__(self):
+        self.server: asyncio.Server | None = None
+        self.port = 0
+        self.clients: dict[asyncio.StreamWriter, set[str]] = {}
+        self.received = 0
+        self.delivered = 0
+        self.received_topics: dict[str, int] = {}
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        for writer in list(self.clients):
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _read_packet(self, reader: asyncio.StreamReader) -> tuple[int, bytes]:
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            digit = (await reader.readexactly(1))[0]
+            length += (digit & 0x7f) * multiplier
+            multiplier *= 128
+            if not digit & 0x80:
+                break
+        return header, await reader.readexactly(length)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients[writer] = set()
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                kind = header >> 4
+                if kind == 1:
+                    writer.write(b'\x20\x02\x00\x00')
+                elif kind == 3:
+                    qos = header >> 1 & 3
+                    topic_length = int.from_bytes(body[:2], 'big')
+                    topic = body[2:2 + topic_length].decode()
+                    position = 2 + topic_length
+                    if qos:
+                        writer.write(b'\x40\x02' + body[position:position + 2])
+                        position += 2
+                    self.received += 1
+                    self.received_topics[topic] = self.received_topics.get(topic, 0) + 1
+                    self.publish(topic, body[position:])
+                elif kind == 8:
+                    packet_id, position, granted = body[:2], 2, bytearray()
+                    while position < len(body):
+                        length = int.from_bytes(body[position:position + 2], 'big')
+                        self.clients[writer].add(body[position + 2:position + 2 + length].decode())
+                        position += 2 + length + 1
+                        granted.append(0)
+                    writer.write(b'\x90' + encode_length(2 + len(granted)) + packet_id + granted)
+                elif kind == 10:
+                    packet_id, position = body[:2], 2
+                    while position < len(body):
+                        length = int.from_bytes(body[position:position + 2], 'big')
+                        self.clients[writer].discard(body[position + 2:position + 2 + length].decode())
+                        position += 2 + length
+                    writer.write(b'\xb0\x02' + packet_id)
+                elif kind == 12:
+                    writer.write(b'\xd0\x00')
+                elif kind == 14:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    def subscribed(self, topic: str) -> bool:
+        return any(topic_matches(subscription, topic)
+                   for subscriptions in self.clients.values() for subscription in subscriptions)
+
+    def publish(self, topic: str, payload: bytes | str):
+        """Delivers a message to every matching subscriber at QoS 0."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        packet = None
+        for writer, subscriptions in self.clients.items():
+            if any(topic_matches(subscription, topic) for subscription in subscriptions):
+                if packet is None:
+                    body = encode_string(topic) + payload
+                    packet = b'\x30' + encode_length(len(body)) + body
+                writer.write(packet)
+                self.delivered += 1
@@ -1,31 +1,263 @@
+import asyncio
+from collections import OrderedDict, defaultdict
+from enum import StrEnum
+from itertools import count
+import json
+import os
+from typing import Hashable, Iterable
+
 from fastapi import WebSocket
 
+from metrics import WS_BROADCAST_SECONDS, WS_FAILED_SENDS
+from misc import logger
+
+
+class OverflowPolicy(StrEnum):
+    drop_oldest = 'drop_oldest'
+    coalesce = 'coalesce'
+    disconnect = 'disconnect'
+
+
+ws_queue_size = int(os.getenv('WS_QUEUE_SIZE', 1000))
+ws_overflow_policy = OverflowPolicy(
+    os.getenv('WS_OVERFLOW_POLICY', OverflowPolicy.drop_oldest))
+# Events published within this window are sent as one array frame per
+# client, with superseded events collapsed. 0 sends every event on its own.
+ws_batch_window = int(os.getenv('WS_BATCH_WINDOW_MS', 0)) / 1000
+
+_message_ids = count()
+
+Topic = tuple[str, Hashable | None]
+
+
+class Connection:
+    """Outgoing queue and writer task of a single websocket."""
+
+    def __init__(self, websocket: WebSocket, queue_size: int, overflow_policy: OverflowPolicy):
+        self.websocket = websocket
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.queue: OrderedDict[Hashable, str] = OrderedDict()
+        self.ready = asyncio.Event()
+        self.writer: asyncio.Task | None = None
+        self.subscriptions: set[Topic] = set()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def enqueue(self, message: str, key: Hashable | None = None) -> bool:
+        if key is None or self.overflow_policy != OverflowPolicy.coalesce:
+            key = next(_message_ids)
+        elif key in self.queue:
+            self.queue[key] = message
+            self.coalesced += 1
+            return True
+        if len(self.queue) >= self.queue_size:
+            if self.overflow_policy == OverflowPolicy.disconnect:
+                return False
+            self.queue.popitem(last=False)
+            self.dropped += 1
+        self.queue[key] = message
+        self.ready.set()
+        return True
+
+    async def write(self):
+        while True:
+            await self.ready.wait()
+            while self.queue:
+                _, message = self.queue.popitem(last=False)
+                await self.websocket.send_text(message)
+                self.sent += 1
+            self.ready.clear()
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    def __init__(self, queue_size: int = ws_queue_size,
+                 overflow_policy: OverflowPolicy = ws_overflow_policy,
+                 batch_window: float = ws_batch_window):
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.batch_window = batch_window
+        self._pending: OrderedDict[Hashable, tuple[str, list[Topic] | None]] = OrderedDict()
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self.active_connections: dict[WebSocket, Connection] = {}
+        self.subscribers: defaultdict[Topic, set[Connection]] = defaultdict(set)
+        self.unfiltered: set[Connection] = set()
+        self.background_tasks: set[asyncio.Task] = set()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.failed_sends = 0
+        self.slow_disconnects = 0
+        self.batches = 0
+        self.superseded = 0
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        connection = Connection(
+            websocket, self.queue_size, self.overflow_policy)
+        connection.writer = asyncio.create_task(self._write(connection))
+        self.active_connections[websocket] = connection
+        self.unfiltered.add(connection)
+
+    async def _write(self, connection: Connection):
+        try:
+            await connection.write()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failed_sends += 1
+            WS_FAILED_SENDS.inc()
+            self.disconnect(connection.websocket)
 
     def disconnect(self, websocket: WebSocket):
+        connection = self.active_connections.pop(websocket, None)
+        if connection is None:
+            return
+        self._remove_subscriptions(connection, list(connection.subscriptions))
+        self.unfiltered.discard(connection)
+        self.sent += connection.sent
+        self.dropped += connection.dropped
+        self.coalesced += connection.coalesced
+        if connection.writer is not None and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+
+    async def _close_slow(self, websocket: WebSocket):
         try:
-            self.active_connections.remove(websocket)
-        except:
+            await asyncio.wait_for(websocket.close(code=1013), timeout=5)
+        except Exception:
             pass
 
     async def close(self):
-        for websocket in self.active_connections:
+        for websocket in list(self.active_connections):
+            self.disconnect(websocket)
             await websocket.close()
-        self.active_connections = []
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str):
-        for websocket in self.active_connections:
-            try:
-                await websocket.send_text(message)
-            except:
-                self.disconnect(websocket)
+        connection = self.active_connections.get(websocket)
+        if connection is None:
+            await websocket.send_text(message)
+        else:
+            self._enqueue(connection, message)
+
+    def _enqueue(self, connection: Connection, message: str, key: Hashable | None = None):
+        if not connection.enqueue(message, key):
+            logger.warning('Disconnecting slow websocket client.')
+            self.slow_disconnects += 1
+            self.disconnect(connection.websocket)
+            task = asyncio.create_task(self._close_slow(connection.websocket))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+    def subscribe(self, websocket: WebSocket, target: str, ids: Iterable[Hashable] | None = None):
+        """Limit a connection to events of the given target ids, or of all
+        ids of the target when none are given. Connections without
+        subscriptions receive every event."""
+        connection = self.active_connections.get(websocket)
+        if connection is None:
+            return
+        for topic in [(target, None)] if ids is None else [(target, id) for id in ids]:
+            connection.subscriptions.add(topic)
+            self.subscribers[topic].add(connection)
+        self.unfiltered.discard(connection)
+
+    def unsubscribe(self, websocket: WebSocket, target: str | None = None, ids: Iterable[Hashable] | None = None):
+        connection = self.active_connections.get(websocket)
+        if connection is None:
+            return
+        if target is None:
+            topics = list(connection.subscriptions)
+        elif ids is None:
+            topics = [topic for topic in connection.subscriptions
+                      if topic[0] == target]
+        else:
+            topics = [(target, id) for id in ids]
+        self._remove_subscriptions(connection, topics)
+
+    def _remove_subscriptions(self, connection: Connection, topics: Iterable[Topic]):
+        for topic in topics:
+            connection.subscriptions.discard(topic)
+            subscribers = self.subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self.subscribers[topic]
+        if not connection.subscriptions:
+            self.unfiltered.add(connection)
+
+    def recipients(self, topics: Iterable[Topic] | None = None) -> Iterable[Connection]:
+        if topics is None:
+            return list(self.active_connections.values())
+        recipients = set(self.unfiltered)
+        for target, id in topics:
+            recipients.update(self.subscribers.get((target, id), ()))
+            recipients.update(self.subscribers.get((target, None), ()))
+        return recipients
+
+    async def broadcast(self, message: str, key: Hashable | None = None,
+                        topics: Iterable[Topic] | None = None):
+        """Sends message right away, after any events still waiting for
+        the batch window so that clients see them in publish order."""
+        with WS_BROADCAST_SECONDS.time():
+            if self._pending:
+                self._flush_handle.cancel()
+                self._send_batch()
+            for connection in self.recipients(topics):
+                self._enqueue(connection, message, key)
+
+    async def publish(self, event: dict, key: Hashable | None = None,
+                      topics: Iterable[Topic] | None = None):
+        message = json.dumps(event)
+        if self.batch_window <= 0:
+            await self.broadcast(message, key, topics)
+            return
+        if key is None:
+            key = next(_message_ids)
+        elif key in self._pending:
+            del self._pending[key]
+            self.superseded += 1
+        self._pending[key] = (message, None if topics is None else list(topics))
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.batch_window, self._flush)
+
+    def _flush(self):
+        with WS_BROADCAST_SECONDS.time():
+            self._send_batch()
+
+    def _send_batch(self):
+        self._flush_handle = None
+        events = list(self._pending.values())
+        self._pending.clear()
+        batches: defaultdict[Connection, list[int]] = defaultdict(list)
+        for i, (_, topics) in enumerate(events):
+            for connection in self.recipients(topics):
+                batches[connection].append(i)
+        frames: dict[tuple[int, ...], str] = {}
+        for connection, indices in batches.items():
+            indices = tuple(indices)
+            if indices not in frames:
+                frames[indices] = '[' + ','.join(events[i][0]
+                                                 for i in indices) + ']'
+            self._enqueue(connection, frames[indices])
+        self.batches += 1
+
+    def stats(self) -> dict:
+        connections = list(self.active_connections.values())
+        return {
+            'connections': len(connections),
+            'subscriptions': sum(len(connection.subscriptions) for connection in connections),
+            'overflow_policy': str(self.overflow_policy),
+            'queue_size': self.queue_size,
+            'queued': sum(len(connection.queue) for connection in connections),
+            'max_queue_depth': max((len(connection.queue) for connection in connections), default=0),
+            'sent': self.sent + sum(connection.sent for connection in connections),
+            'dropped': self.dropped + sum(connection.dropped for connection in connections),
+            'coalesced': self.coalesced + sum(connection.coalesced for connection in connections),
+            'failed_sends': self.failed_sends,
+            'slow_disconnects': self.slow_disconnects,
+            'batch_window': self.batch_window,
+            'batches': self.batches,
+            'superseded': self.superseded,
+            'pending': len(self._pending),
+        }
@@ -6,10 +6,13 @@ import motor.motor_asyncio
 from beanie import Document
 from fastapi_users.db import BeanieBaseUser, BeanieUserDatabase
 
+from metrics import MongoCommandListener
+
 
 mongodb_url = 'mongodb://%s:%s@%s:27017/%s' % tuple(map(quote_plus, (os.environ['MONGO_INITDB_USERNAME'], os.environ['MONGO_INITDB_PASSWORD'], os.environ['MONGO_INITDB_HOSTNAME'], os.environ['MONGO_INITDB_DATABASE'])))
 client = motor.motor_asyncio.AsyncIOMotorClient(
-    mongodb_url, uuidRepresentation='standard'
+    mongodb_url, uuidRepresentation='standard',
+    event_listeners=[MongoCommandListener()]
 )
 db = client['users']
 
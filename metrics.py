@@ -0,0 +1,94 @@
+from typing import Callable
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+NETBOX_FETCH_SECONDS = Histogram(
+    'netbox_fetch_seconds', 'Duration of DataLoader fetch stages per NetBox endpoint.',
+    ['endpoint', 'mode'], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+SNAPSHOT_ENTITIES = Gauge(
+    'snapshot_entities', 'Entities in the current DataLoader snapshot.', ['collection'])
+SNAPSHOT_BYTES = Gauge(
+    'snapshot_bytes', 'Encoded size of the current DataLoader snapshot.', ['collection', 'encoding'])
+SNAPSHOT_VERSION = Gauge(
+    'snapshot_version', 'Version of the current DataLoader snapshot.')
+WATCHDOG_TRIPS = Counter(
+    'dataloader_watchdog_trips_total', 'DataLoader fetches that exceeded the time limit.')
+
+WS_BROADCAST_SECONDS = Histogram(
+    'ws_broadcast_seconds', 'Time spent fanning one message or batch out to websocket queues.',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5))
+WS_FAILED_SENDS = Counter(
+    'ws_failed_sends_total', 'Websocket sends that failed and closed the connection.')
+
+MQTT_MESSAGES = Counter(
+    'mqtt_messages_total', 'MQTT messages received.', ['topic'])
+MQTT_HANDLER_SECONDS = Histogram(
+    'mqtt_handler_seconds', 'Duration of the MQTT message handler.', ['topic'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+
+MONGO_COMMAND_SECONDS = Histogram(
+    'mongo_command_seconds', 'Duration of MongoDB commands.',
+    ['database', 'collection', 'command', 'status'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_seconds', 'Duration of HTTP requests per route.',
+    ['method', 'route', 'status'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10))
+
+
+def topic_label(topic: str) -> str:
+    """Collapses per-entity topic levels to keep label cardinality bounded."""
+    levels = topic.split('/')
+    return '/'.join(level if not level.isdigit() else '+' for level in levels)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    ignored_commands = {'hello', 'ismaster', 'isMaster', 'ping', 'saslStart',
+                        'saslContinue', 'endSessions', 'buildInfo'}
+
+    def __init__(self):
+        self.pending: dict[tuple, tuple[str, str]] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name in self.ignored_commands:
+            return
+        collection = event.command.get(
+            'collection' if event.command_name == 'getMore' else event.command_name)
+        if not isinstance(collection, str):
+            collection = ''
+        self.pending[event.connection_id, event.request_id] = (
+            event.database_name, collection)
+
+    def _finish(self, event, status: str):
+        labels = self.pending.pop((event.connection_id, event.request_id), None)
+        if labels is not None:
+            MONGO_COMMAND_SECONDS.labels(*labels, event.command_name, status) \
+                .observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finish(event, 'ok')
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._finish(event, 'error')
+
+
+class StatsCollector:
+    """Exposes the numeric values of a stats() dict as gauges at scrape time."""
+
+    def __init__(self, prefix: str, stats: Callable[[], dict], documentation: str):
+        self.prefix = prefix
+        self.stats = stats
+        self.documentation = documentation
+
+    def collect(self):
+        for name, value in self.stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield GaugeMetricFamily(f'{self.prefix}_{name}', self.documentation, value=value)
+
+
+def register_stats(prefix: str, stats: Callable[[], dict], documentation: str):
+    REGISTRY.register(StatsCollector(prefix, stats, documentation))
+
@@ -0,0 +1,134 @@
+import asyncio
+from collections import deque
+import time
+from typing import Awaitable, Callable
+
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure, PyMongoError
+
+from misc import logger
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def is_transient(error: PyMongoError) -> bool:
+    return isinstance(error, ConnectionFailure) or error.has_error_label('RetryableWriteError') \
+        or (isinstance(error, OperationFailure) and error.code in (91, 189, 11600, 11602, 13435, 13436))
+
+
+class WriteBehindBuffer:
+    """Buffers documents in memory and writes them to a collection with
+    unordered insert_many calls, by size or time threshold."""
+
+    def __init__(self, collection, flush_size: int = 500, flush_interval: float = 1,
+                 max_size: int = 50000, max_backoff: float = 30,
+                 on_flush: Callable[[list[dict]], Awaitable] | None = None):
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_backoff = max_backoff
+        self.on_flush = on_flush
+        self.buffer: deque[tuple[float, dict]] = deque()
+        self.written = 0
+        self.dropped = 0
+        self.failures = 0
+        self.last_flush_duration = 0.0
+        self._consecutive_failures = 0
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # The loop is stopped rather than cancelled, so a batch that is
+        # being written is finished and handed to on_flush.
+        if self._task is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self.buffer:
+            logger.error('Write-behind buffer for %s closed with %d unwritten documents.',
+                         self.collection.name, len(self.buffer))
+
+    def append(self, document: dict):
+        if len(self.buffer) >= self.max_size:
+            self.buffer.popleft()
+            self.dropped += 1
+        self.buffer.append((time.time(), document))
+        if len(self.buffer) >= self.flush_size:
+            self._wakeup.set()
+
+    async def _wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while not self._closing:
+            await self._wait(self.flush_interval)
+            self._wakeup.clear()
+            if not await self.flush() and not self._closing:
+                await self._wait(min(2 ** self._consecutive_failures, self.max_backoff))
+
+    async def flush(self) -> bool:
+        async with self._lock:
+            while self.buffer:
+                batch = [self.buffer.popleft()
+                         for _ in range(min(self.flush_size, len(self.buffer)))]
+                documents = [document for _, document in batch]
+                start = time.perf_counter()
+                rejected = set()
+                try:
+                    await self.collection.insert_many(documents, ordered=False)
+                except BulkWriteError as e:
+                    # Documents keep their _id across retries, so duplicates
+                    # are writes that already succeeded.
+                    errors = [error for error in e.details.get('writeErrors', [])
+                              if error.get('code') != DUPLICATE_KEY_ERROR]
+                    if errors:
+                        logger.error('Dropped %d documents rejected by %s: %s',
+                                     len(errors), self.collection.name, errors[0].get('errmsg'))
+                        rejected = {error['index'] for error in errors}
+                        self.dropped += len(rejected)
+                except PyMongoError as e:
+                    if not is_transient(e):
+                        logger.exception(e)
+                        self.dropped += len(batch)
+                        continue
+                    logger.warning('Write-behind flush to %s failed, retrying: %s',
+                                   self.collection.name, e)
+                    self.failures += 1
+                    self._consecutive_failures += 1
+                    self.buffer.extendleft(reversed(batch))
+                    while len(self.buffer) > self.max_size:
+                        self.buffer.popleft()
+                        self.dropped += 1
+                    return False
+                self.last_flush_duration = time.perf_counter() - start
+                self._consecutive_failures = 0
+                self.written += len(batch) - len(rejected)
+                if self.on_flush is not None:
+                    try:
+                        await self.on_flush([document for i, document in enumerate(documents)
+                                             if i not in rejected])
+                    except Exception as e:
+                        logger.exception(e)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self.buffer),
+            'lag_seconds': time.time() - self.buffer[0][0] if self.buffer else 0,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failures': self.failures,
+            'last_flush_duration': self.last_flush_duration,
+            'max_size': self.max_size,
+        }
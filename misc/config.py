@@ -0,0 +1,49 @@
+import asyncio
+import os
+
+import yaml
+
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+from misc.files import atomic_write
+
+
+class ConfigFile:
+    """YAML file that is parsed once and cached until it changes on disk.
+    All file I/O runs in a worker thread, and writes replace the file
+    atomically so readers never see a partial file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._data = None
+        self._version: tuple | None = None
+        self._lock = asyncio.Lock()
+
+    def _stat_version(self) -> tuple:
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read(self):
+        version = self._stat_version()
+        if version == self._version:
+            return self._data
+        with open(self.path) as f:
+            data = yaml.load(f, Loader=SafeLoader)
+        self._data, self._version = data, version
+        return data
+
+    def _write(self, data):
+        text = yaml.dump(data, Dumper=SafeDumper)
+        atomic_write(self.path, lambda f: f.write(text), prefix='.config-', suffix='.yml')
+        self._data, self._version = data, self._stat_version()
+
+    async def get(self):
+        async with self._lock:
+            return await asyncio.to_thread(self._read)
+
+    async def set(self, data):
+        async with self._lock:
+            await asyncio.to_thread(self._write, data)
@@ -1,12 +1,40 @@
 import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import os
-from threading import Lock, Thread
+from threading import Event, Lock, Thread
 import time
 from typing import Callable
 import pynetbox
+from metrics import NETBOX_FETCH_SECONDS, SNAPSHOT_BYTES, SNAPSHOT_ENTITIES, SNAPSHOT_VERSION, WATCHDOG_TRIPS
 from misc import logger
+from misc.snapshot import Snapshot, diff, load as load_snapshot, save as save_snapshot
 
 max_netbox_fetch_time = 60 * 5
+netbox_id_filter_chunk_size = 200
+netbox_fetch_concurrency = int(os.getenv('NETBOX_FETCH_CONCURRENCY', 6))
+# Incremental syncs are only used between full syncs; 0 disables them.
+netbox_full_sync_interval = int(os.getenv('NETBOX_FULL_SYNC_INTERVAL', 60 * 60))
+# Margin subtracted from the previous sync time to absorb clock skew.
+netbox_sync_skew = 60
+# Last good snapshot, served as stale after a restart until NetBox has been
+# fetched again. Unset or empty disables it.
+snapshot_path = os.getenv('SNAPSHOT_PATH', '')
+
+netbox_endpoints = {
+    'interfaces': ('dcim', 'interfaces'),
+    'ip_addresses': ('ipam', 'ip_addresses'),
+    'tags': ('extras', 'tags'),
+    'locations': ('dcim', 'locations'),
+    'power_ports': ('dcim', 'power_ports'),
+    'devices': ('dcim', 'devices'),
+}
+
+link_peer_endpoints = {
+    'dcim.poweroutlet': ('dcim', 'power_outlets'),
+    'dcim.powerfeed': ('dcim', 'power_feeds'),
+}
 
 
 class DataLoader(Thread):
@@ -18,64 +46,84 @@ class DataLoader(Thread):
         self.is_initialized = False
         self.needs_reload = True
         self.lock = Lock()
-        self.intermediate_data = {
-            'interfaces': [],
-            'devices': [],
-            'ip_addresses': [],
-            'tags': [],
-            'locations': [],
-            'power_ports': []
-        }
-        self._data = {
-            'devices': [],
-            'tags': [],
-            'locations': []
-        }
+        self.intermediate_data: dict[str, dict[int, dict]] = {
+            name: {} for name in netbox_endpoints}
+        self._snapshot = Snapshot(0, {})
         self._is_fetching = False
         self._start_fetch_time = time.time()
         self._end_fetch_time = time.time()
+        self.fetch_timings: dict[str, float] = {}
+        self.sync_mode = 'full'
+        self._last_sync_time: datetime | None = None
+        self._last_full_sync_time = 0.0
+        self._reload_requested = Event()
+        self._ready = asyncio.Event()
 
     async def __aenter__(self):
-        while not self.is_initialized:
-            await asyncio.sleep(1)
+        await self._ready.wait()
         return self
 
     async def __aexit__(self, *_):
         pass
 
     @property
-    def devices(self):
+    def snapshot(self) -> Snapshot:
         self.lock.acquire()
-        result = self._data['devices']
+        result = self._snapshot
         self.lock.release()
         return result
 
+    @property
+    def devices(self):
+        return self.snapshot['devices']
+
     @property
     def tags(self):
-        self.lock.acquire()
-        result = self._data['tags']
-        self.lock.release()
-        return result
+        return self.snapshot['tags']
 
     @property
     def locations(self):
-        self.lock.acquire()
-        result = self._data['locations']
-        self.lock.release()
-        return result
+        return self.snapshot['locations']
 
     def reload(self):
         self.needs_reload = True
+        self._reload_requested.set()
 
     def _watchdog(self):
         while True:
             if self._is_fetching and (time.time() - self._start_fetch_time) > max_netbox_fetch_time:
                 logger.error('DataLoader fetch took too long.')
+                WATCHDOG_TRIPS.inc()
                 if self.on_error:
                     self.on_error()
             time.sleep(1)
 
+    def _set_ready(self):
+        self.loop.call_soon_threadsafe(self._ready.set)
+
+    def _restore(self):
+        if not snapshot_path or not os.path.exists(snapshot_path):
+            return
+        try:
+            snapshot = load_snapshot(snapshot_path)
+        except Exception as e:
+            logger.exception(e)
+            return
+        self.lock.acquire()
+        self._snapshot = snapshot
+        self.lock.release()
+        logger.info('Serving stale snapshot %d from %s until NetBox is fetched.',
+                    snapshot.version, snapshot_path)
+        self._set_ready()
+
+    def _persist(self, snapshot: Snapshot):
+        try:
+            save_snapshot(snapshot, snapshot_path)
+        except Exception as e:
+            logger.exception(e)
+
     def run(self):
+        self._restore()
         apiToken = os.getenv('NETBOX_API_TOKEN')
         nb = pynetbox.api(os.getenv('NETBOX_API_URL'),
                           token=apiToken,
@@ -93,56 +141,158 @@ class DataLoader(Thread):
         self._watchdog_thread.start()
 
         while True:
-            if self.needs_reload or not self.is_initialized:
+            if self.needs_reload or not self.is_initialized or (
+                    netbox_full_sync_interval > 0 and self._full_sync_due()):
                 self._is_fetching = True
                 self._start_fetch_time = time.time()
-                self.intermediate_data['interfaces'] = [
-                    dict(interface) for interface in nb.dcim.interfaces.all()]
-                self.intermediate_data['ip_addresses'] = [
-                    dict(ip_address) for ip_address in nb.ipam.ip_addresses.all()]
-                self.intermediate_data['tags'] = [dict(tag)
-                                                  for tag in nb.extras.tags.all()]
-                self.intermediate_data['locations'] = [
-                    dict(location) for location in nb.dcim.locations.all()]
-                self.intermediate_data['power_ports'] = list(
-                    nb.dcim.power_ports.all())
-                self.intermediate_data['devices'] = self._get_devices(
-                    [device for device in nb.dcim.devices.all()
-                     if device.primary_ip is not None
-                     and device['status']['value'] == 'active'])
+                self._reload_requested.clear()
+                self.needs_reload = False
+                sync_start = datetime.now(timezone.utc)
+                if self._full_sync_due():
+                    self.sync_mode = 'full'
+                    self._fetch_all(nb)
+                    self._last_full_sync_time = self._start_fetch_time
+                else:
+                    self.sync_mode = 'incremental'
+                    self._fetch_all(nb, since=self._last_sync_time -
+                                    timedelta(seconds=netbox_sync_skew))
+                self._last_sync_time = sync_start
+                devices = self._timed('join', self._get_devices, [
+                    device for device in self.intermediate_data['devices'].values()
+                    if device['primary_ip'] is not None
+                    and device['status']['value'] == 'active'])
+                previous = self._snapshot
+                snapshot = self._timed('encode', Snapshot, previous.version + 1, {
+                    'devices': devices,
+                    'tags': list(self.intermediate_data['tags'].values()),
+                    'locations': list(self.intermediate_data['locations'].values()),
+                })
+                changes = self._timed('diff', diff, previous, snapshot) \
+                    if previous.version else None
+                self.fetch_timings['total'] = time.time() - self._start_fetch_time
+                logger.info('DataLoader %s fetch timings: %s', self.sync_mode, ', '.join(
+                    f'{name}={duration:.2f}s' for name, duration in self.fetch_timings.items()))
                 self._is_fetching = False
                 self.lock.acquire()
-                self._data['devices'] = self.intermediate_data['devices'].copy()
-                self._data['tags'] = self.intermediate_data['tags'].copy()
-                self._data['locations'] = self.intermediate_data['locations'].copy()
+                self._snapshot = snapshot
                 self.lock.release()
+                self._observe(snapshot)
                 if self.on_reload:
                     asyncio.run_coroutine_threadsafe(
-                        self.on_reload(), self.loop)
+                        self.on_reload(snapshot.version, changes), self.loop)
                 self.is_initialized = True
-                self.needs_reload = False
+                self._set_ready()
+                if snapshot_path:
+                    self._persist(snapshot)
             else:
-                time.sleep(60)
+                self._reload_requested.wait(60)
+
+    def _observe(self, snapshot: Snapshot):
+        for name, duration in self.fetch_timings.items():
+            NETBOX_FETCH_SECONDS.labels(name, self.sync_mode).observe(duration)
+        for name, payload in snapshot.payloads.items():
+            if name in snapshot.data:
+                SNAPSHOT_ENTITIES.labels(name).set(len(snapshot[name]))
+            SNAPSHOT_BYTES.labels(name, 'json').set(len(payload.json))
+            SNAPSHOT_BYTES.labels(name, 'gzip').set(len(payload.gzip))
+        SNAPSHOT_VERSION.set(snapshot.version)
+
+    def _full_sync_due(self) -> bool:
+        return (self._last_sync_time is None
+                or netbox_full_sync_interval <= 0
+                or time.time() - self._last_full_sync_time >= netbox_full_sync_interval)
+
+    def _timed(self, name: str, function: Callable, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.fetch_timings[name] = time.perf_counter() - start
+        return result
+
+    def _fetch_endpoint(self, nb, name: str) -> dict[int, dict]:
+        app, endpoint = netbox_endpoints[name]
+        endpoint = getattr(getattr(nb, app), endpoint)
+        records = self._timed(name, lambda: {
+            record['id']: record for record in map(dict, endpoint.all())})
+        if name == 'power_ports':
+            self._timed('power_port_peers', self._resolve_link_peers,
+                        nb, list(records.values()))
+        return records
+
+    def _sync_endpoint(self, nb, name: str, since: datetime) -> dict[int, dict]:
+        app, endpoint = netbox_endpoints[name]
+        endpoint = getattr(getattr(nb, app), endpoint)
+
+        def sync():
+            changed = {record['id']: record for record in map(
+                dict, endpoint.filter(last_updated__gte=since.isoformat()))}
+            ids = {record.id for record in endpoint.filter(brief=1)}
+            records = {id: record for id, record in self.intermediate_data[name].items()
+                       if id in ids}
+            records.update(changed)
+            return records, changed
+
+        records, changed = self._timed(name, sync)
+        if name == 'power_ports':
+            self._timed('power_port_peers', self._resolve_link_peers,
+                        nb, list(changed.values()))
+        return records
+
+    def _fetch_all(self, nb, since: datetime | None = None):
+        with ThreadPoolExecutor(max_workers=netbox_fetch_concurrency,
+                                thread_name_prefix='netbox-fetch') as executor:
+            futures = {
+                name: executor.submit(self._fetch_endpoint, nb, name) if since is None
+                else executor.submit(self._sync_endpoint, nb, name, since)
+                for name in netbox_endpoints}
+            for name, future in futures.items():
+                self.intermediate_data[name] = future.result()
+
+    def _resolve_link_peers(self, nb, power_ports: list[dict]) -> list[dict]:
+        peer_ids = defaultdict(set)
+        for power_port in power_ports:
+            if power_port.get('link_peers_type') in link_peer_endpoints:
+                peer_ids[power_port['link_peers_type']].update(
+                    peer['id'] for peer in power_port['link_peers'])
+
+        peers = {}
+        for peer_type, ids in peer_ids.items():
+            app, name = link_peer_endpoints[peer_type]
+            endpoint = getattr(getattr(nb, app), name)
+            ids = sorted(ids)
+            for i in range(0, len(ids), netbox_id_filter_chunk_size):
+                for peer in endpoint.filter(id=ids[i:i + netbox_id_filter_chunk_size]):
+                    peers[peer_type, peer.id] = dict(peer)
+
+        for power_port in power_ports:
+            peer_type = power_port.get('link_peers_type')
+            power_port['link_peers'] = [
+                peers.get((peer_type, peer['id']), peer) for peer in power_port.get('link_peers') or []]
+        return power_ports
 
     def _get_devices(self, rawDevices) -> list:
-        devices = [
-            {
-                **dict(device),
-                'interfaces': [dict(interface) for interface in self.intermediate_data['interfaces'] if interface['device']['id'] == device['id']],
-            } for device in rawDevices
-        ]
-        for i, device in enumerate(devices):
-            ip_address = [
-                ip_address for ip_address in self.intermediate_data['ip_addresses'] if ip_address['id'] == device['primary_ip']['id']][0]
-            dev_power_ports = [
-                power_port for power_port in self.intermediate_data['power_ports'] if power_port['device']['id'] == device['id']]
-            [[peer.full_details() for peer in p.link_peers]
-                for p in dev_power_ports]
-            devices[i]['power_ports'] = [
-                dict(port) for port in dev_power_ports]
-            devices[i]['primary_ip'] = dict(ip_address)
-            devices[i]['tags'] = ip_address['tags']
-
-        devices = [device for device in devices
-                   if device['status']['value'] == 'active']
+        interfaces_by_device = defaultdict(list)
+        for interface in self.intermediate_data['interfaces'].values():
+            interfaces_by_device[interface['device']['id']].append(interface)
+        ip_addresses_by_id = {
+            ip_address['id']: ip_address for ip_address in self.intermediate_data['ip_addresses'].values()}
+        power_ports_by_device = defaultdict(list)
+        for power_port in self.intermediate_data['power_ports'].values():
+            power_ports_by_device[power_port['device']['id']].append(power_port)
+
+        devices = []
+        for device in rawDevices:
+            if device['status']['value'] != 'active':
+                continue
+            ip_address = ip_addresses_by_id.get(device['primary_ip']['id'])
+            if ip_address is None:
+                logger.warning('Primary IP %s of device %s not found.',
+                               device['primary_ip']['id'], device['id'])
+                continue
+            devices.append({
+                **device,
+                'interfaces': [dict(interface) for interface in interfaces_by_device[device['id']]],
+                'power_ports': [dict(port) for port in power_ports_by_device[device['id']]],
+                'primary_ip': dict(ip_address),
+                'tags': ip_address['tags'],
+            })
         return devices
@@ -0,0 +1,35 @@
+import errno
+import os
+import shutil
+import tempfile
+from typing import IO, Callable
+
+
+def atomic_write(path: str, write: Callable[[IO], None], binary: bool = False,
+                 prefix: str = '.tmp-', suffix: str = ''):
+    """Writes path through a temporary file in the same directory that is
+    fsynced and renamed over it, so readers see either the old or the new
+    file, never a partial one. The new file keeps the mode of the old."""
+    mode = 'wb' if binary else 'w'
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix=prefix, suffix=suffix)
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        try:
+            os.replace(temp_path, path)
+        except OSError as e:
+            # A file bind-mounted on its own cannot be replaced.
+            if e.errno not in (errno.EBUSY, errno.EXDEV):
+                raise
+            with open(path, mode) as f:
+                write(f)
+            os.unlink(temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
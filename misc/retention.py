@@ -0,0 +1,133 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+import json
+import time
+import zlib
+
+from bson import Binary, ObjectId
+from pymongo import ASCENDING
+
+from misc import logger
+from misc.rollups import KNXRollups
+
+
+class KNXRetention:
+    """Moves KNX events older than the retention horizon out of the events
+    collection, either into compressed monthly archive documents ('archive')
+    or nowhere, keeping only the rollups ('rollups'). In 'rollups' mode,
+    events stored before the rollups began, or flagged unapplied because
+    their batch failed to apply, are archived all the same, as no bucket
+    covers them.
+
+    Event age is taken from the ObjectId assigned at insert time, so the
+    _id index drives the job. An archive document holds the zlib compressed
+    JSON list of up to batch_size events of one month."""
+
+    def __init__(self, events, archive, rollups: KNXRollups, days: int, mode: str = 'archive',
+                 interval: float = 60 * 60, batch_size: int = 5000):
+        if mode not in ('archive', 'rollups'):
+            raise ValueError(f'Invalid KNX retention mode "{mode}"')
+        self.events = events
+        self.archive = archive
+        self.rollups = rollups
+        self.days = days
+        self.mode = mode
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_run: dict = {}
+        self._task: asyncio.Task | None = None
+
+    async def ensure_indexes(self):
+        await self.archive.create_index([('month', ASCENDING)], name='month')
+
+    def start(self):
+        if self.days > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        start = time.perf_counter()
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.days)
+        horizon = ObjectId.from_datetime(cutoff)
+        archived = deleted = 0
+        since = self.rollups.since
+        query = {'_id': {'$lt': horizon}}
+        if self.mode == 'rollups' and since is not None:
+            # Failed batches still waiting to be flagged end the deletion.
+            bound = min([horizon, *self.rollups.unapplied])
+            deleted += (await self.events.delete_many(
+                {'_id': {'$gte': since, '$lt': bound}, 'unapplied': {'$ne': True}})).deleted_count
+            query['$or'] = [{'_id': {'$lt': since}}, {'unapplied': True}]
+        while True:
+            events = await self.events.find(query).sort('_id', ASCENDING) \
+                .limit(self.batch_size).to_list(self.batch_size)
+            if not events:
+                break
+            for month, month_events in groupby(
+                    events, key=lambda event: event['_id'].generation_time.strftime('%Y-%m')):
+                archived += await self._archive(month, list(month_events))
+            deleted += (await self.events.delete_many(
+                {'_id': {'$in': [event['_id'] for event in events]}})).deleted_count
+        self.last_run = {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'cutoff': cutoff.isoformat(),
+            'archived': archived,
+            'deleted': deleted,
+            'duration': time.perf_counter() - start,
+        }
+        logger.info('KNX retention: %s', self.last_run)
+
+    async def _archive(self, month: str, events: list[dict]) -> int:
+        times = [time for time in (event.get('data', {}).get('event', {}).get('time')
+                                   for event in events) if isinstance(time, (int, float))]
+        data = zlib.compress(json.dumps(events, default=str).encode(), level=9)
+        # Keyed by the first event, so a run interrupted before the delete
+        # overwrites its own archive document instead of duplicating it.
+        await self.archive.replace_one({'_id': f'{month}:{events[0]["_id"]}'}, {
+            'month': month,
+            'count': len(events),
+            'first_id': events[0]['_id'],
+            'last_id': events[-1]['_id'],
+            'from_time': min(times, default=None),
+            'to_time': max(times, default=None),
+            'data': Binary(data),
+        }, upsert=True)
+        return len(events)
+
+    async def stats(self) -> dict:
+        storage = {}
+        for collection in (self.events, self.archive, self.rollups.collection):
+            try:
+                result = await collection.database.command('collStats', collection.name)
+                storage[collection.name] = {key: result.get(key, 0) for key in (
+                    'count', 'size', 'storageSize', 'totalIndexSize')}
+            except Exception as e:
+                storage[collection.name] = {'error': str(e)}
+        return {
+            'retention_days': self.days,
+            'mode': self.mode,
+            'rollups_since': str(self.rollups.since) if self.rollups.since else None,
+            'rollups_unflagged': len(self.rollups.unapplied),
+            'interval': self.interval,
+            'storage': storage,
+            'last_run': self.last_run,
+        }
@@ -0,0 +1,158 @@
+from collections import defaultdict
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+granularities = {
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+
+def event_seconds(time: float) -> float:
+    """KNX event times are epoch seconds or, from some sources, milliseconds."""
+    return time / 1000 if time > 1e11 else time
+
+
+def is_applicable(event: dict) -> bool:
+    """Events without a numeric time or a value do not move a switch."""
+    data = event.get('data')
+    data = data.get('event') if isinstance(data, dict) else None
+    return isinstance(data, dict) and isinstance(data.get('time'), (int, float)) \
+        and data.get('value') is not None and 'target' in event
+
+
+class KNXRollups:
+    """Incrementally maintained per-location hourly and daily buckets of KNX
+    switch events: transition count, on-seconds and last value."""
+
+    def __init__(self, collection, state_collection, events):
+        self.collection = collection
+        self.state_collection = state_collection
+        self.events = events
+        self.state: dict[int, tuple[bool, float]] = {}
+        # Oldest event applied to the rollups. Events before it, stored
+        # before rollups existed, are not covered by any bucket.
+        self.since: ObjectId | None = None
+        # Events of batches that failed to apply and are not yet flagged as
+        # unapplied in the events collection.
+        self.unapplied: list[ObjectId] = []
+
+    async def ensure_indexes(self):
+        await self.collection.create_index(
+            [('granularity', ASCENDING), ('location', ASCENDING), ('start', ASCENDING)],
+            name='granularity_location_start')
+
+    async def load(self):
+        self.state = {}
+        async for document in self.state_collection.find():
+            if document['_id'] == 'since':
+                self.since = document['event_id']
+            else:
+                self.state[document['_id']] = (document['value'], document['time'])
+
+    async def _record_since(self, events: list[dict]):
+        first = min((event['_id'] for event in events if isinstance(event.get('_id'), ObjectId)),
+                    default=None)
+        if first is None or (self.since is not None and self.since <= first):
+            return
+        document = await self.state_collection.find_one_and_update(
+            {'_id': 'since'}, {'$min': {'event_id': first}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        self.since = document['event_id']
+
+    async def _flag_unapplied(self):
+        ids, self.unapplied = self.unapplied, []
+        try:
+            await self.events.update_many({'_id': {'$in': ids}}, {'$set': {'unapplied': True}})
+        except Exception:
+            self.unapplied = ids + self.unapplied
+            raise
+
+    async def apply(self, events: list[dict]):
+        """Folds a batch of stored events into the buckets. The events of a
+        batch that fails are flagged unapplied, so retention keeps them."""
+        try:
+            await self._apply(events)
+        except Exception:
+            self.unapplied.extend(event['_id'] for event in events
+                                  if isinstance(event.get('_id'), ObjectId))
+            raise
+        finally:
+            if self.unapplied:
+                await self._flag_unapplied()
+
+    async def _apply(self, events: list[dict]):
+        state = dict(self.state)
+        buckets = defaultdict(lambda: {'transitions': 0, 'on_seconds': 0.0, 'events': 0,
+                                       'last_value': None, 'last_time': None})
+
+        def bucket(location, granularity, time):
+            size = granularities[granularity]
+            return buckets[location, granularity, int(time - time % size)]
+
+        for event in sorted((event for event in events if is_applicable(event)),
+                            key=lambda event: event['data']['event']['time']):
+            location = event['target']
+            value = bool(event['data']['event']['value'])
+            time = event_seconds(event['data']['event']['time'])
+            previous = state.get(location)
+            if previous is not None and time < previous[1]:
+                continue
+            if previous is not None and previous[0]:
+                start = previous[1]
+                for granularity, size in granularities.items():
+                    position = start
+                    while position < time:
+                        end = min(position - position % size + size, time)
+                        bucket(location, granularity, position)['on_seconds'] += end - position
+                        position = end
+            for granularity in granularities:
+                current = bucket(location, granularity, time)
+                current['events'] += 1
+                if previous is None or previous[0] != value:
+                    current['transitions'] += 1
+                current['last_value'] = value
+                current['last_time'] = time
+            state[location] = (value, time)
+
+        requests = []
+        for (location, granularity, start), values in buckets.items():
+            update = {'$inc': {'transitions': values['transitions'],
+                               'on_seconds': values['on_seconds'],
+                               'events': values['events']},
+                      '$setOnInsert': {'location': location, 'granularity': granularity,
+                                       'start': start}}
+            if values['last_time'] is not None:
+                # Older events than the applied state are skipped, so a
+                # batch never moves last_value backwards in time.
+                update['$set'] = {'last_value': values['last_value'],
+                                  'last_time': values['last_time']}
+            requests.append(UpdateOne(
+                {'_id': f'{location}:{granularity}:{start}'}, update, upsert=True))
+        if requests:
+            await self.collection.bulk_write(requests, ordered=False)
+        changed = {location: value for location, value in state.items()
+                   if self.state.get(location) != value}
+        if changed:
+            await self.state_collection.bulk_write([UpdateOne(
+                {'_id': location}, {'$set': {'value': value, 'time': time}}, upsert=True)
+                for location, (value, time) in changed.items()], ordered=False)
+        await self._record_since(events)
+        self.state = state
+
+    async def query(self, granularity: str, from_time: float | None = None,
+                    to_time: float | None = None, locations: list[int] | None = None) -> list[dict]:
+        query = {'granularity': granularity}
+        if locations:
+            query['location'] = {'$in': locations}
+        if from_time is not None or to_time is not None:
+            query['start'] = {}
+            if from_time is not None:
+                size = granularities[granularity]
+                query['start']['$gte'] = int(from_time - from_time % size)
+            if to_time is not None:
+                query['start']['$lte'] = to_time
+        return [{key: value for key, value in document.items() if key != '_id'}
+                async for document in self.collection.find(query).sort(
+                    [('location', ASCENDING), ('start', ASCENDING)])]
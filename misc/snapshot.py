@@ -0,0 +1,90 @@
+import gzip
+import hashlib
+import json
+import os
+from types import MappingProxyType
+
+from misc.files import atomic_write
+
+collections = ('devices', 'tags', 'locations')
+
+
+def encode_json(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False, allow_nan=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def device_topics(device: dict) -> tuple[tuple[str, int], ...]:
+    """Location and tag subscriptions that also receive the device's events."""
+    topics = [('tag', tag['id']) for tag in device.get('tags') or ()]
+    if device.get('location'):
+        topics.append(('location', device['location']['id']))
+    return tuple(topics)
+
+
+class EncodedPayload:
+    """JSON body of one collection, encoded once and served as is."""
+
+    def __init__(self, body: bytes):
+        self.json = body
+        self.gzip = gzip.compress(body, compresslevel=6)
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.etag = '"%s"' % digest
+        self.gzip_etag = '"%s-gzip"' % digest
+
+
+class Snapshot:
+    """Immutable, versioned view of the data published by the DataLoader."""
+
+    def __init__(self, version: int, data: dict[str, list], stale: bool = False):
+        self.version = version
+        # Loaded from disk and not yet confirmed by a NetBox fetch.
+        self.stale = stale
+        self.data = MappingProxyType(
+            {name: tuple(data.get(name, ())) for name in collections})
+        bodies = {name: encode_json(data.get(name, []))
+                  for name in collections}
+        bodies['all'] = b'{' + b','.join(
+            encode_json(name) + b':' + bodies[name] for name in collections) + b'}'
+        self.payloads = MappingProxyType(
+            {name: EncodedPayload(body) for name, body in bodies.items()})
+        self.device_topics = MappingProxyType({
+            device['id']: device_topics(device) for device in self.data['devices']})
+
+    def __getitem__(self, name: str) -> tuple:
+        return self.data[name]
+
+
+def diff(old: Snapshot, new: Snapshot) -> dict[str, dict[str, list]]:
+    """Per-collection changes between two snapshots, keyed by entity id."""
+    changes = {}
+    for name in collections:
+        before = {item['id']: item for item in old[name]}
+        after = {item['id']: item for item in new[name]}
+        changes[name] = {
+            'added': [item for id, item in after.items() if id not in before],
+            'changed': [item for id, item in after.items()
+                        if id in before and before[id] != item],
+            'removed': [id for id in before if id not in after],
+        }
+    return changes
+
+
+def save(snapshot: Snapshot, path: str):
+    """Writes the snapshot to a gzip file atomically. The file reuses the
+    compressed 'all' payload as the middle member of a multi-member gzip
+    stream, so persisting does not compress the data a second time."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def write(f):
+        f.write(gzip.compress(b'{"version":%d,"data":' % snapshot.version))
+        f.write(snapshot.payloads['all'].gzip)
+        f.write(gzip.compress(b'}'))
+
+    atomic_write(path, write, binary=True, prefix='.snapshot-', suffix='.json.gz')
+
+
+def load(path: str) -> Snapshot:
+    with open(path, 'rb') as f:
+        document = json.loads(gzip.decompress(f.read()))
+    return Snapshot(document['version'], document['data'], stale=True)
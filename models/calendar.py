@@ -1,7 +1,8 @@
 from enum import StrEnum
 from typing import Optional
 from bson import ObjectId
-from pydantic import BaseModel, Field
+from dateutil.rrule import rrulestr
+from pydantic import BaseModel, Field, validator
 from datetime import datetime
 from . import PyObjectId
 
@@ -35,6 +36,15 @@ class EventModel(BaseModel):
     duration: Optional[float] = Field()
     extendedProps: ExtendedPropsModel = Field()
 
+    @validator('rrule')
+    def validate_rrule(cls, rrule, values):
+        if rrule and 'start' in values:
+            try:
+                rrulestr(rrule, dtstart=values['start'], forceset=True)
+            except (ValueError, TypeError) as e:
+                raise ValueError(f'Invalid rrule: {e}')
+        return rrule
+
     class Config:
         allow_population_by_field_name = True
         arbitrary_types_allowed = True
@@ -48,3 +58,8 @@ class UpdateEventModel(BaseModel):
     end: Optional[datetime]
     allDay: Optional[bool]
     extendedProps: Optional[ExtendedPropsModel]
+
+
+class BulkEventsModel(BaseModel):
+    upsert: list[EventModel] = Field(default_factory=list)
+    delete: list[str] = Field(default_factory=list)
@@ -0,0 +1,23 @@
+from enum import StrEnum
+from typing import Any
+from pydantic import BaseModel, Field
+
+
+class MethodTarget(StrEnum):
+    device = 'device'
+    tag = 'tag'
+    location = 'location'
+
+
+class CommandTargetModel(BaseModel):
+    target: MethodTarget = Field()
+    id: int = Field()
+
+
+class BulkCommandModel(BaseModel):
+    targets: list[CommandTargetModel] = Field(default_factory=list)
+    # Selectors, resolved to the active devices with any of these tags or
+    # in any of these locations.
+    tags: list[int] = Field(default_factory=list)
+    locations: list[int] = Field(default_factory=list)
+    params: dict[str, Any] = Field(default_factory=dict)
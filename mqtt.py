@@ -1,5 +1,8 @@
+import asyncio
+import json
 import os
 import ssl
+from uuid import uuid4
 
 from fastapi_mqtt import FastMQTT, MQTTConfig
 from gmqtt.mqtt.constants import MQTTv311
@@ -7,13 +10,20 @@ from gmqtt.mqtt.constants import MQTTv311
 CA_CERTIFICATE = '/opt/tls/ca_certificate.pem'
 CLIENT_CERTIFICATE = '/opt/tls/client_certificate.pem'
 CLIENT_KEY = '/opt/tls/client_key.pem'
-ssl_context = ssl.create_default_context(cafile=CA_CERTIFICATE)
-ssl_context.load_cert_chain(
-    CLIENT_CERTIFICATE, CLIENT_KEY)
+# Plain TCP is only meant for local brokers, such as the benchmark stand-in.
+mqtt_tls = os.getenv('MQTT_TLS', '1') != '0'
+mqtt_port = int(os.getenv('MQTT_PORT', 8883 if mqtt_tls else 1883))
+
+if mqtt_tls:
+    ssl_context = ssl.create_default_context(cafile=CA_CERTIFICATE)
+    ssl_context.load_cert_chain(
+        CLIENT_CERTIFICATE, CLIENT_KEY)
+else:
+    ssl_context = False
 
 mqtt_config = MQTTConfig(
     host=os.environ['MQTT_HOSTNAME'],
-    port=8883,
+    port=mqtt_port,
     keepalive=60,
     ssl=ssl_context,
     version=MQTTv311
@@ -24,6 +34,51 @@ mqtt = FastMQTT(
     client_id='api'
 )
 
+rpc_reply_topic = 'api/reply'
+rpc_timeout = float(os.getenv('MQTT_RPC_TIMEOUT', 5))
+
+
+class RPC:
+    """Request/reply over MQTT. Commands carry a correlation id and a reply
+    topic in their JSON payload, since MQTT 3.1.1 has no message properties.
+    A reply is any message that echoes the correlation id, either on the
+    reply topic or in a manager event."""
+
+    def __init__(self, mqtt: FastMQTT, reply_topic: str):
+        self.mqtt = mqtt
+        self.reply_topic = reply_topic
+        self.pending: dict[str, asyncio.Future] = {}
+        self.timeouts = 0
+
+    async def call(self, topic: str, payload: dict, timeout: float = rpc_timeout, qos: int = 1):
+        correlation_id = uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self.pending[correlation_id] = future
+        try:
+            self.mqtt.publish(topic, json.dumps({
+                **payload,
+                'correlation_id': correlation_id,
+                'reply_to': self.reply_topic,
+            }), qos=qos)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.pending.pop(correlation_id, None)
+
+    def resolve(self, payload) -> bool:
+        if not isinstance(payload, dict) or not isinstance(payload.get('correlation_id'), str):
+            return False
+        future = self.pending.get(payload['correlation_id'])
+        if future is None or future.done():
+            return False
+        future.set_result(payload)
+        return True
+
+
+rpc = RPC(mqtt, rpc_reply_topic)
+
 
 @mqtt.on_connect()
 def mqtt_on_connect(*_):
@@ -33,3 +88,4 @@ def mqtt_on_connect(*_):
     mqtt.client.subscribe('manager/tag_event', qos=0)
     mqtt.client.subscribe('manager/location_event', qos=0)
     mqtt.client.subscribe('knx/#', qos=0)
+    mqtt.client.subscribe(rpc_reply_topic, qos=0)
@@ -1,27 +1,52 @@
 import asyncio
 import json
+import os
 from typing import Annotated
 from enum import StrEnum
 
-from fastapi import Depends, APIRouter, Body, WebSocket, Query, HTTPException
-from mqtt import mqtt
+from fastapi import Depends, APIRouter, Body, WebSocket, Query, HTTPException, Request, Response
+from mqtt import mqtt, rpc, rpc_timeout
 
 from users import current_active_user, UserManager, get_user_manager, JWTStrategy, get_jwt_strategy
 from connection_manager import ConnectionManager
 from misc import logger
 from misc.data import DataLoader
+from models.command import BulkCommandModel, CommandTargetModel, MethodTarget
+
+# Identical websocket fetches share one MQTT publish until the manager's
+# correlated reply arrives or the collapse window closes. Requests waiting
+# for a reply give up after the timeout.
+fetch_timeout = float(os.getenv('WS_FETCH_TIMEOUT', rpc_timeout))
+fetch_collapse_window = int(os.getenv('WS_FETCH_COLLAPSE_MS', 250)) / 1000
+
+bulk_command_rate = float(os.getenv('BULK_COMMAND_RATE', 100))
+bulk_command_batch_size = int(os.getenv('BULK_COMMAND_BATCH_SIZE', 20))
+bulk_command_semaphore = asyncio.Semaphore(
+    int(os.getenv('BULK_COMMAND_CONCURRENCY', 2)))
 
 manager = ConnectionManager()
 
+background_tasks: set[asyncio.Task] = set()
+
+fetch_flights: dict[tuple[str, str], asyncio.Future] = {}
+# Flights a websocket awaits a correlated reply from.
+awaited_flights: set[asyncio.Future] = set()
+fetch_stats = {'published': 0, 'collapsed': 0}
+
 router = APIRouter(dependencies=[Depends(current_active_user)])
 
 
-async def on_reload():
+async def on_reload(version: int | None = None, changes: dict | None = None):
     mqtt.publish('api/data-refresh', qos=1)
+    if changes is None:
+        event = {'type': 'refresh', 'version': version}
+    else:
+        event = {'type': 'patch', 'version': version,
+                 'base_version': version - 1, 'changes': changes}
     await manager.broadcast(json.dumps({
         'target': 'app',
         'data': {
-            'event': {'type': 'refresh'}
+            'event': event
         }
     }))
 
@@ -42,45 +67,210 @@ async def data_refresh():
     data_loader.reload()
 
 
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether gzip, or * without a gzip entry, has a non-zero q-value."""
+    qualities = {}
+    for item in accept_encoding.lower().split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+    return qualities.get('gzip', qualities.get('*', 0)) > 0
+
+
+def snapshot_response(request: Request, name: str) -> Response:
+    snapshot = data_loader.snapshot
+    payload = snapshot.payloads[name]
+    gzipped = accepts_gzip(request.headers.get('accept-encoding', ''))
+    etag = payload.gzip_etag if gzipped else payload.etag
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding',
+               'X-Snapshot-Version': str(snapshot.version)}
+    if snapshot.stale:
+        headers['X-Snapshot-Stale'] = '1'
+    if_none_match = request.headers.get('if-none-match', '')
+    if if_none_match.strip() == '*' or etag in (
+            tag.strip().removeprefix('W/') for tag in if_none_match.split(',')):
+        return Response(status_code=304, headers=headers)
+    if gzipped:
+        return Response(payload.gzip, media_type='application/json',
+                        headers={**headers, 'Content-Encoding': 'gzip'})
+    return Response(payload.json, media_type='application/json', headers=headers)
+
+
 @router.get('/')
-async def get():
-    return {
-        'devices': await get_devices(),
-        'tags': await get_tags(),
-        'locations': await get_locations(),
-    }
+async def get(request: Request) -> Response:
+    async with data_loader:
+        return snapshot_response(request, 'all')
 
 
 @router.get('/devices')
-async def get_devices() -> list:
+async def get_devices(request: Request) -> Response:
     async with data_loader:
-        return data_loader.devices
+        return snapshot_response(request, 'devices')
 
 
 @router.get('/tags')
-async def get_tags() -> list:
+async def get_tags(request: Request) -> Response:
     async with data_loader:
-        return data_loader.tags
+        return snapshot_response(request, 'tags')
 
 
 @router.get('/locations')
-async def get_locations() -> list:
+async def get_locations(request: Request) -> Response:
     async with data_loader:
-        return data_loader.locations
+        return snapshot_response(request, 'locations')
+
+
+@router.get('/ws/stats')
+async def ws_stats():
+    return {**manager.stats(), 'fetch': fetch_stats}
 
 
-class MethodTarget(StrEnum):
+@router.get('/data/stats')
+async def data_stats():
+    snapshot = data_loader.snapshot
+    return {
+        'version': snapshot.version,
+        'stale': snapshot.stale,
+        'sync_mode': data_loader.sync_mode,
+        'timings': dict(data_loader.fetch_timings),
+    }
+
+
+class SubscriptionTarget(StrEnum):
     device = 'device'
     tag = 'tag'
     location = 'location'
+    knx = 'knx'
+
+
+def subscription_ids(message: dict) -> list[int] | None:
+    if 'ids' in message:
+        return [int(id) for id in message['ids']]
+    if 'id' in message:
+        return [int(message['id'])]
+    return None
+
+
+def resolve_targets(command: BulkCommandModel) -> list[CommandTargetModel]:
+    targets = {(target.target, target.id): target for target in command.targets}
+    if command.tags or command.locations:
+        tags, locations = set(command.tags), set(command.locations)
+        snapshot = data_loader.snapshot
+        for device in snapshot['devices']:
+            if any((topic == 'tag' and id in tags) or (topic == 'location' and id in locations)
+                   for topic, id in snapshot.device_topics.get(device['id'], ())):
+                targets.setdefault((MethodTarget.device, device['id']), CommandTargetModel(
+                    target=MethodTarget.device, id=device['id']))
+    return list(targets.values())
+
+
+@router.post('/bulk/{method_name}')
+async def bulk_method(method_name, command: BulkCommandModel = Body()):
+    """Publishes method_name once per target, paced to BULK_COMMAND_RATE
+    messages per second. Each message carries params plus the target id."""
+    async with data_loader:
+        targets = resolve_targets(command)
+    results = []
+    async with bulk_command_semaphore:
+        for i, target in enumerate(targets):
+            if i and i % bulk_command_batch_size == 0 and bulk_command_rate > 0:
+                await asyncio.sleep(bulk_command_batch_size / bulk_command_rate)
+            result = {'target': str(target.target), 'id': target.id}
+            try:
+                mqtt.publish(f'api/{str(target.target)}/{method_name}',
+                             json.dumps({**command.params, 'id': target.id}),
+                             qos=1)
+                result['status'] = 'published'
+            except Exception as e:
+                logger.exception(e)
+                result['status'] = 'failed'
+                result['error'] = str(e)
+            results.append(result)
+    return {
+        'method': method_name,
+        'published': sum(result['status'] == 'published' for result in results),
+        'failed': sum(result['status'] == 'failed' for result in results),
+        'results': results,
+    }
 
 
 @router.post('/{target}/{method_name}')
-async def method(target: MethodTarget, method_name, params: Annotated[dict, Body()]):
+async def method(target: MethodTarget, method_name, params: Annotated[dict, Body()],
+                 wait: bool = Query(False),
+                 timeout: float = Query(rpc_timeout, gt=0, le=60)):
+    """Publishes the method call. With wait, responds with the manager's
+    correlated reply instead, or 504 when none arrives within timeout."""
     logger.debug('Method %s %s', target, method_name)
-    mqtt.publish(f'api/{str(target)}/{method_name}',
-                 json.dumps(params),
-                 qos=1)
+    topic = f'api/{str(target)}/{method_name}'
+    if not wait:
+        mqtt.publish(topic, json.dumps(params), qos=1)
+        return
+    try:
+        return await rpc.call(topic, params, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(504, 'No reply from manager')
+
+
+def single_flight_fetch(message: dict) -> asyncio.Future:
+    """Publishes a fetch unless an identical one is already waiting for the
+    manager's reply, and returns the shared future of that reply."""
+    payload = {key: value for key, value in message.items() if key != 'request_id'}
+    key = (str(message['target']), json.dumps(payload, sort_keys=True))
+    flight = fetch_flights.get(key)
+    if flight is not None:
+        fetch_stats['collapsed'] += 1
+        return flight
+    fetch_stats['published'] += 1
+    flight = asyncio.ensure_future(rpc.call(
+        f'api/{message["target"]}/fetch', payload, timeout=fetch_timeout, qos=0))
+    fetch_flights[key] = flight
+    window = asyncio.get_running_loop().call_later(
+        fetch_collapse_window, end_fetch_flight, key, flight)
+
+    def land(flight: asyncio.Future):
+        window.cancel()
+        if fetch_flights.get(key) is flight:
+            del fetch_flights[key]
+        awaited_flights.discard(flight)
+        if not flight.cancelled():
+            flight.exception()
+
+    flight.add_done_callback(land)
+    return flight
+
+
+def end_fetch_flight(key: tuple[str, str], flight: asyncio.Future):
+    """Ends collapsing into flight. Flights nobody awaits a reply from are
+    cancelled instead of left to time out."""
+    if fetch_flights.get(key) is flight:
+        del fetch_flights[key]
+    if flight not in awaited_flights:
+        flight.cancel()
+
+
+async def reply_to_fetch(websocket: WebSocket, message: dict):
+    try:
+        flight = single_flight_fetch(message)
+        awaited_flights.add(flight)
+        result = await asyncio.shield(flight)
+        event = {'type': 'reply', 'request_id': message['request_id'], 'result': result}
+    except asyncio.TimeoutError:
+        event = {'type': 'reply', 'request_id': message['request_id'],
+                 'error': {'message': 'No reply from manager'}}
+    await manager.send_personal_message(json.dumps({
+        'target': 'app',
+        'data': {
+            'event': event
+        }
+    }), websocket)
 
 
 @router.websocket('/ws')
@@ -94,15 +284,34 @@ async def ws(websocket: WebSocket, token: str = Query(...),
             if user is None:
                 raise HTTPException(401)
         except:
+            manager.disconnect(websocket)
             await websocket.send_json({'error': {'message': 'Authentication failed'}})
             await websocket.close(code=1000)
             return
+        snapshot = data_loader.snapshot
+        await manager.send_personal_message(json.dumps({
+            'target': 'app',
+            'data': {
+                'event': {'type': 'version', 'version': snapshot.version,
+                          'stale': snapshot.stale}
+            }
+        }), websocket)
         while True:
             try:
                 message = await websocket.receive_json()
-                if message['command'] == 'fetch':
-                    mqtt.publish(
-                        f'api/{message["target"]}/fetch', json.dumps(message))
+                if message['command'] == 'fetch' and 'request_id' in message:
+                    task = asyncio.create_task(reply_to_fetch(websocket, message))
+                    background_tasks.add(task)
+                    task.add_done_callback(background_tasks.discard)
+                elif message['command'] == 'fetch':
+                    single_flight_fetch(message)
+                elif message['command'] == 'subscribe':
+                    manager.subscribe(websocket, SubscriptionTarget(
+                        message['target']), subscription_ids(message))
+                elif message['command'] == 'unsubscribe':
+                    target = message.get('target')
+                    manager.unsubscribe(websocket, target and SubscriptionTarget(target),
+                                        subscription_ids(message))
             except:
                 manager.disconnect(websocket)
                 break
@@ -1,42 +1,235 @@
-from datetime import datetime
-from fastapi import Depends, APIRouter, Body, status
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Iterable
+import json
+from dateutil.rrule import rrulestr
+from fastapi import Depends, APIRouter, Body, HTTPException, Response, status
 from fastapi.encoders import jsonable_encoder
-from models.calendar import EventModel, UpdateEventModel
+import pymongo
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from models.calendar import BulkEventsModel, EventModel, UpdateEventModel
 from users import current_active_user
 from db import client
+from misc import logger
 from mqtt import mqtt
 
 db = client['calendar']
 
+# Start and end are stored as ISO strings, so candidate queries are padded
+# to cover UTC offsets and results are filtered after parsing.
+window_padding = timedelta(days=1)
+max_occurrences_per_event = 10000
+occurrence_cache_size = 1024
+# Number of revisions kept in the change log. Consumers that fall further
+# behind are told to reload everything.
+change_log_size = 1000
+
+_occurrence_cache: OrderedDict[tuple, list[datetime]] = OrderedDict()
+
 router = APIRouter(dependencies=[Depends(current_active_user)])
 
 
+async def ensure_indexes():
+    await db['events'].create_index([('start', pymongo.ASCENDING)], name='start')
+    await db['events'].create_index([('end', pymongo.ASCENDING)], name='end')
+
+
+async def current_revision() -> int:
+    latest = await db['changes'].find_one(sort=[('_id', pymongo.DESCENDING)])
+    return latest['_id'] if latest else 0
+
+
+async def publish_change(upserted: Iterable[str] = (), deleted: Iterable[str] = ()) -> int:
+    """Records a calendar revision in the change log and notifies the
+    manager with the new revision number."""
+    meta = await db['meta'].find_one_and_update(
+        {'_id': 'revision'}, {'$inc': {'value': 1}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    revision = meta['value']
+    await db['changes'].insert_one({
+        '_id': revision,
+        'upserted': list(upserted),
+        'deleted': list(deleted),
+        'time': datetime.now(timezone.utc),
+    })
+    await db['changes'].delete_many({'_id': {'$lte': revision - change_log_size}})
+    mqtt.publish('api/calendar/update', json.dumps({'revision': revision}), qos=1)
+    return revision
+
+
 @router.get('/calendar/get_events')
-async def get_events():
+async def get_events(response: Response):
+    response.headers['X-Calendar-Revision'] = str(await current_revision())
     events = []
     async for event in db['events'].find():
         events.append(jsonable_encoder(event))
     return events
 
 
+def parse_datetime(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+
+def align(value: datetime, reference: datetime) -> datetime:
+    """Make value comparable to reference, which may be naive or aware."""
+    if reference.tzinfo is None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    if reference.tzinfo is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def event_duration(event: dict) -> timedelta:
+    if event.get('duration'):
+        return timedelta(milliseconds=event['duration'])
+    if event.get('end'):
+        return parse_datetime(event['end']) - parse_datetime(event['start'])
+    return timedelta(days=1) if event.get('allDay') else timedelta()
+
+
+def expand(event: dict, start: datetime, end: datetime) -> list[datetime]:
+    key = (event['_id'], event['rrule'], event['start'],
+           event.get('end'), event.get('duration'), start, end)
+    if key in _occurrence_cache:
+        _occurrence_cache.move_to_end(key)
+        return _occurrence_cache[key]
+    duration = event_duration(event)
+    rule = rrulestr(event['rrule'], dtstart=parse_datetime(event['start']), forceset=True)
+    first = next(iter(rule), None)
+    occurrences = []
+    if first is not None:
+        window_start, window_end = align(start, first), align(end, first)
+        for occurrence in islice(rule.xafter(window_start - duration, inc=True),
+                                 max_occurrences_per_event):
+            if occurrence >= window_end:
+                break
+            if occurrence + duration > window_start or occurrence == window_start:
+                occurrences.append(occurrence)
+    _occurrence_cache[key] = occurrences
+    if len(_occurrence_cache) > occurrence_cache_size:
+        _occurrence_cache.popitem(last=False)
+    return occurrences
+
+
+@router.get('/calendar/changes')
+async def get_changes(since: int):
+    """Events upserted and ids deleted after revision `since`. With reset
+    set, the change log no longer reaches back that far and the consumer
+    has to reload all events."""
+    upserted, deleted = set(), set()
+    revision = since
+    async for change in db['changes'].find({'_id': {'$gt': since}}).sort('_id', pymongo.ASCENDING):
+        if change['_id'] != revision + 1:
+            # A gap is either trimmed history or a change still being
+            # recorded; stop before it.
+            if revision == since:
+                return {'revision': await current_revision(), 'reset': True,
+                        'upserted': [], 'deleted': []}
+            break
+        revision = change['_id']
+        upserted.update(change['upserted'])
+        upserted.difference_update(change['deleted'])
+        deleted.difference_update(change['upserted'])
+        deleted.update(change['deleted'])
+    if revision == since and since > await current_revision():
+        return {'revision': await current_revision(), 'reset': True,
+                'upserted': [], 'deleted': []}
+    events = [jsonable_encoder(event) async for event in
+              db['events'].find({'_id': {'$in': list(upserted)}})]
+    return {'revision': revision, 'reset': False,
+            'upserted': events, 'deleted': sorted(deleted)}
+
+
+@router.get('/calendar/get_occurrences')
+async def get_occurrences(start: datetime, end: datetime):
+    """Occurrences of all events overlapping [start, end), with recurring
+    events expanded server-side into one entry per occurrence."""
+    if end <= start:
+        raise HTTPException(400, 'end must be after start')
+    padded_start = (start - window_padding).isoformat()
+    padded_end = (end + window_padding).isoformat()
+    recurring = {'rrule': {'$type': 'string', '$ne': ''}}
+    cursor = db['events'].find({'$or': [
+        {**recurring, 'start': {'$lte': padded_end}},
+        {'rrule': {'$in': [None, '']}, 'start': {'$lte': padded_end}, '$or': [
+            {'end': {'$gte': padded_start}},
+            {'end': None, 'start': {'$gte': padded_start}},
+        ]},
+    ]})
+    occurrences = []
+    async for event in cursor:
+        event = jsonable_encoder(event)
+        if event.get('rrule'):
+            duration = event_duration(event)
+            try:
+                expanded = expand(event, start, end)
+            except (ValueError, TypeError) as e:
+                logger.warning('Skipping calendar event %s with invalid rrule: %s', event['_id'], e)
+                continue
+            for occurrence in expanded:
+                occurrences.append({
+                    **event,
+                    'start': occurrence.isoformat(),
+                    'end': (occurrence + duration).isoformat(),
+                    'rrule': None,
+                    'recurrence_id': event['_id'],
+                })
+        else:
+            event_start = parse_datetime(event['start'])
+            event_end = event_start + event_duration(event)
+            if event_start < align(end, event_start) and (
+                    event_end > align(start, event_start) or event_start >= align(start, event_start)):
+                occurrences.append(event)
+    occurrences.sort(key=lambda occurrence: occurrence['start'])
+    return occurrences
+
+
+def upsert_spec(event: EventModel) -> tuple[dict, dict]:
+    payload = jsonable_encoder(event)
+    return {'_id': payload.pop('_id')}, {'$set': payload}
+
+
 @router.post('/calendar/save_event')
 async def save_event(event: EventModel = Body()):
-    payload = jsonable_encoder(event)
-    if await db['events'].find_one({'_id': payload['_id']}) != None:
-        await db['events'].update_one({'_id': str(payload['_id'])}, {"$set": payload})
-        response = status.HTTP_200_OK
-    else:
-        await db['events'].insert_one(payload)
-        response = status.HTTP_201_CREATED
-    mqtt.publish('api/calendar/update', qos=1)
-    return response
+    filter, update = upsert_spec(event)
+    result = await db['events'].update_one(filter, update, upsert=True)
+    await publish_change(upserted=[filter['_id']])
+    if result.upserted_id is not None:
+        return status.HTTP_201_CREATED
+    return status.HTTP_200_OK
+
+
+@router.post('/calendar/save_events')
+async def save_events(events: BulkEventsModel = Body()):
+    """Upserts and deletes many events with one unordered bulk write and a
+    single calendar update notification."""
+    specs = [upsert_spec(event) for event in events.upsert]
+    upserted = [filter['_id'] for filter, _ in specs]
+    operations = [UpdateOne(filter, update, upsert=True) for filter, update in specs] + \
+        [DeleteOne({'_id': id}) for id in events.delete]
+    if not operations:
+        return {'upserted': 0, 'modified': 0, 'deleted': 0}
+    try:
+        result = await db['events'].bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        await publish_change(upserted, events.delete)
+        raise HTTPException(400, [
+            {key: error.get(key) for key in ('index', 'code', 'errmsg')}
+            for error in e.details.get('writeErrors', [])])
+    await publish_change(upserted, events.delete)
+    return {
+        'upserted': result.upserted_count,
+        'modified': result.modified_count,
+        'deleted': result.deleted_count,
+    }
 
 
 @router.delete('/calendar/delete_event/{id}')
 async def delete_event(id: str):
-    if await db['events'].find_one({'_id': id}) != None:
-        await db['events'].delete_one({'_id': id})
-        mqtt.publish('api/calendar/update', qos=1)
+    if (await db['events'].delete_one({'_id': id})).deleted_count:
+        await publish_change(deleted=[id])
         return None
     else:
         return status.HTTP_404_NOT_FOUND
@@ -1,26 +1,28 @@
 from typing import Annotated
-import yaml
 
 from fastapi import Body, Depends, APIRouter
 
 from users import current_active_admin
 from connection_manager import ConnectionManager
 from misc import logger
+from misc.config import ConfigFile
 from .base import on_reload
 
 manager = ConnectionManager()
 
+config_file = ConfigFile('/manager/config/config.yml')
+
 router = APIRouter(dependencies=[Depends(current_active_admin)])
 
 
 @router.get('/')
 async def get():
-    with open('/manager/config/config.yml') as f:
-        return yaml.safe_load(f)
+    return await config_file.get()
 
 
 @router.post('/')
-async def post_devicemap(body: Annotated[list, Body()]):
-    with open('/manager/config/config.yml', 'w') as f:
-        yaml.dump(body, f)
+async def post_devicemap(body: Annotated[list[dict], Body()]):
+    """Replaces the device map, a list of mappings; anything else is
+    rejected with 422 before the file is touched."""
+    await config_file.set(body)
     await on_reload()
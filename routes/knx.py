@@ -1,30 +1,192 @@
 from datetime import datetime
-from fastapi import Depends, APIRouter
+from enum import StrEnum
+import json
+import os
+from bson import ObjectId
+from fastapi import Depends, APIRouter, HTTPException, Query
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 import pymongo
 from users import current_active_user
 from db import client
 from misc import logger
+from misc.buffer import WriteBehindBuffer
+from misc.rollups import KNXRollups
+from misc.retention import KNXRetention
 
 db = client['knx']
 
+rollups = KNXRollups(db['rollups'], db['rollup_state'], db['events'])
+
+event_buffer = WriteBehindBuffer(
+    db['events'],
+    on_flush=rollups.apply,
+    flush_size=int(os.getenv('KNX_FLUSH_SIZE', 500)),
+    flush_interval=float(os.getenv('KNX_FLUSH_INTERVAL', 1)),
+    max_size=int(os.getenv('KNX_BUFFER_SIZE', 50000)))
+
+retention = KNXRetention(
+    db['events'], db['archive'], rollups,
+    days=int(os.getenv('KNX_RETENTION_DAYS', 0)),
+    mode=os.getenv('KNX_RETENTION_MODE', 'archive'),
+    interval=float(os.getenv('KNX_RETENTION_INTERVAL', 60 * 60)))
+
+# Latest value and time of each KNX switch, keyed by location id.
+live_state: dict[int, dict] = {}
+
 router = APIRouter(dependencies=[Depends(current_active_user)])
 
 
+class RollupGranularity(StrEnum):
+    hour = 'hour'
+    day = 'day'
+
+
+class EventFormat(StrEnum):
+    json = 'json'
+    ndjson = 'ndjson'
+
+
+event_sort = [('data.event.time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+stream_chunk_size = 200
+
+
+async def ensure_indexes():
+    await db['events'].create_index(event_sort, name='time_id')
+    await db['events'].create_index(
+        [('target', pymongo.ASCENDING), *event_sort], name='target_time_id')
+    await rollups.ensure_indexes()
+    await retention.ensure_indexes()
+
+
+def encode_cursor(event: dict) -> str:
+    return f'{event["data"]["event"]["time"]}_{event["_id"]}'
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        time, id = cursor.rsplit('_', 1)
+        time, id = json.loads(time), ObjectId(id)
+    except Exception:
+        raise HTTPException(400, 'Invalid cursor')
+    return {'$or': [
+        {'data.event.time': {'$lt': time}},
+        {'data.event.time': time, '_id': {'$lt': id}},
+    ]}
+
+
 @router.get('/knx/get_events')
-async def get_events():
-    events = []
-    aggregate_events = db['events'].aggregate(
-        [{'$sort': {'data.event.time': pymongo.DESCENDING}}])
-    async for event in aggregate_events:
-        event['_id'] = str(event['_id'])
-        events.append(jsonable_encoder(event))
-    return events
+async def get_events(limit: int = Query(1000, ge=1, le=10000),
+                     cursor: str | None = None,
+                     from_time: int | None = Query(None, alias='from'),
+                     to_time: int | None = Query(None, alias='to'),
+                     location: list[int] | None = Query(None),
+                     format: EventFormat = EventFormat.json):
+    """Events newest first, one page per request. The X-Next-Cursor header
+    holds the cursor of the next page and is absent on the last page. A page
+    holds more than `limit` events if events are stored while it is read.
+    Events without a numeric time have no place in the order and are left out."""
+    query = {'data.event.time': {'$type': 'number'}}
+    if location:
+        query['target'] = {'$in': location}
+    for key, value in (('$gte', from_time), ('$lte', to_time)):
+        if value is not None:
+            query['data.event.time'][key] = value
+    if cursor:
+        query = {'$and': [query, decode_cursor(cursor)]}
+
+    headers = {}
+    boundary = await db['events'].find(query, {'data.event.time': 1}) \
+        .sort(event_sort).skip(limit - 1).limit(2).to_list(2)
+    if len(boundary) == 2:
+        last = boundary[0]
+        headers['X-Next-Cursor'] = encode_cursor(last)
+        # The page runs down to the cursor event rather than taking `limit`
+        # events, so events stored after the boundary query make the page
+        # longer instead of pushing events past the cursor.
+        query = {'$and': [query, {'$or': [
+            {'data.event.time': {'$gt': last['data']['event']['time']}},
+            {'data.event.time': last['data']['event']['time'], '_id': {'$gte': last['_id']}},
+        ]}]}
+
+    async def stream():
+        ndjson = format == EventFormat.ndjson
+        chunk = [] if ndjson else ['[']
+        count = 0
+        async for event in db['events'].find(query).sort(event_sort):
+            event['_id'] = str(event['_id'])
+            encoded = json.dumps(event, default=str)
+            if ndjson:
+                chunk.append(encoded + '\n')
+            else:
+                chunk.append(encoded if count == 0 else ',' + encoded)
+            count += 1
+            if len(chunk) >= stream_chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        if not ndjson:
+            chunk.append(']')
+        if chunk:
+            yield ''.join(chunk)
+
+    media_type = 'application/x-ndjson' if format == EventFormat.ndjson else 'application/json'
+    return StreamingResponse(stream(), media_type=media_type, headers=headers)
+
+
+async def load_state():
+    async for state in db['events'].aggregate([
+        {'$match': {'data.event.time': {'$type': 'number'},
+                    'data.event.value': {'$exists': True}}},
+        {'$sort': {'target': pymongo.ASCENDING, 'data.event.time': pymongo.DESCENDING,
+                   '_id': pymongo.DESCENDING}},
+        {'$group': {'_id': '$target',
+                    'value': {'$first': '$data.event.value'},
+                    'time': {'$first': '$data.event.time'}}},
+    ]):
+        update_state(state['_id'], state)
+
+
+def update_state(location_id: int, event: dict):
+    time = event.get('time')
+    if not isinstance(time, (int, float)) or event.get('value') is None:
+        return
+    current = live_state.get(location_id)
+    if current is None or time >= current['time']:
+        live_state[location_id] = {'value': event['value'], 'time': time}
+
+
+@router.get('/knx/state')
+async def get_state(location: list[int] | None = Query(None)):
+    if not location:
+        return live_state
+    return {id: live_state[id] for id in location if id in live_state}
+
+
+@router.get('/knx/rollups')
+async def get_rollups(granularity: RollupGranularity = RollupGranularity.hour,
+                      from_time: float | None = Query(None, alias='from'),
+                      to_time: float | None = Query(None, alias='to'),
+                      location: list[int] | None = Query(None)):
+    """Per-location buckets with transition count, on-seconds and last value.
+    Times are epoch seconds. On-time is added to the buckets when the switch
+    turns off, so a location that is still on has last_value true and the
+    time since last_time is not yet included."""
+    return await rollups.query(str(granularity), from_time, to_time, location)
+
+
+@router.get('/knx/retention')
+async def get_retention():
+    return await retention.stats()
+
+
+@router.get('/knx/buffer')
+async def get_buffer():
+    return event_buffer.stats()
 
 
 async def save_event(event):
     try:
         payload = jsonable_encoder(event)
-        await db['events'].insert_one(payload)
+        event_buffer.append(payload)
     except Exception as e:
         logger.exception(e)
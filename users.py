@@ -1,8 +1,11 @@
 import os
+from collections import OrderedDict
 from typing import Any, Optional
 import contextlib
+import time
 
 from beanie import PydanticObjectId
+import jwt
 from fastapi import Response, Query, APIRouter, Depends, Request
 from fastapi_users import BaseUserManager, FastAPIUsers
 from fastapi_users.authentication import (
@@ -16,6 +19,53 @@ from db import db, User, get_user_db
 
 SECRET = os.environ['API_SECRET']
 
+auth_cache_ttl = float(os.getenv('AUTH_CACHE_TTL', 60))
+auth_cache_size = int(os.getenv('AUTH_CACHE_SIZE', 10000))
+
+
+class UserCache:
+    """Verified token to user, bounded by TTL, token expiry and LRU size."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[float, User]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> User | None:
+        entry = self.entries.get(token)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[token]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, token: str, user: User, expires_at: float | None = None):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        ttl = self.ttl if expires_at is None else min(self.ttl, expires_at - time.time())
+        if ttl <= 0:
+            return
+        self.entries[token] = (time.monotonic() + ttl, user)
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        for token, (_, user) in list(self.entries.items()):
+            if user.id == user_id:
+                del self.entries[token]
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+user_cache = UserCache(auth_cache_ttl, auth_cache_size)
+
 
 class UserManager(ObjectIDIDMixin, BaseUserManager[User, PydanticObjectId]):
     reset_password_token_secret = SECRET
@@ -35,6 +85,17 @@ class UserManager(ObjectIDIDMixin, BaseUserManager[User, PydanticObjectId]):
         print(
             f'Verification requested for user {user.id}. Verification token: {token}')
 
+    async def on_after_update(
+        self, user: User, update_dict: dict[str, Any], request: Optional[Request] = None
+    ):
+        user_cache.invalidate(user.id)
+
+    async def on_after_reset_password(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
 
 async def get_user_manager(user_db: BeanieUserDatabase = Depends(get_user_db)):
     yield UserManager(user_db)
@@ -44,8 +105,26 @@ get_user_manager_context = contextlib.asynccontextmanager(get_user_manager)
 bearer_transport = BearerTransport(tokenUrl='auth/jwt/login')
 
 
+class CachedJWTStrategy(JWTStrategy):
+    async def read_token(self, token: Optional[str], user_manager: BaseUserManager) -> Optional[User]:
+        if token is None:
+            return None
+        user = user_cache.get(token)
+        if user is not None:
+            return user
+        user = await super().read_token(token, user_manager)
+        if user is not None:
+            # The signature was verified by read_token above.
+            expires_at = jwt.decode(token, options={'verify_signature': False}).get('exp')
+            user_cache.set(token, user, expires_at)
+        return user
+
+
+jwt_strategy = CachedJWTStrategy(secret=SECRET, lifetime_seconds=48*60*60)
+
+
 def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(secret=SECRET, lifetime_seconds=48*60*60)
+    return jwt_strategy
 
 
 auth_backend = AuthenticationBackend(